@@ -325,6 +325,42 @@ def load_model(filepath, custom_objects=None, compile=True):
             f.close()
 
 
+def predict_single(model, x):
+    """Returns predictions for one batch of samples, typically a single one,
+    without the input checks and the batch loop of `predict`.
+
+    The backend predict function is built on the first call and kept on the
+    model. The inputs are fed as they are, so they must already have the
+    shapes and dtypes the model expects, e.g. preallocated arrays that the
+    caller fills anew for every call.
+
+    # Arguments
+        model: a `Model` or `Sequential` instance.
+        x: input data, as a Numpy array or list of Numpy arrays
+            (if the model has multiple inputs).
+
+    # Returns
+        A Numpy array of predictions, or a list of them
+        (if the model has multiple outputs).
+    """
+    if isinstance(model, Sequential):
+        if not model.built:
+            model.build()
+        model = model.model
+    cached = getattr(model, '_predict_single_function', None)
+    if cached is None:
+        model._make_predict_function()
+        if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+            learning_phase = [0.]
+        else:
+            learning_phase = []
+        cached = (model.predict_function, learning_phase)
+        model._predict_single_function = cached
+    f, learning_phase = cached
+    outputs = f((x if isinstance(x, list) else [x]) + learning_phase)
+    return outputs[0] if len(outputs) == 1 else outputs
+
+
 def model_from_config(config, custom_objects=None):
     """Instantiates a Keras model from its config.
 
@@ -1077,6 +1113,14 @@ class Sequential(Model):
             self.build()
         return self.model.predict_on_batch(x)
 
+    def predict_single(self, x):
+        """Returns predictions for one batch of samples, skipping the
+        input checks and the batch loop of `predict`.
+
+        See `predict_single` at module level.
+        """
+        return predict_single(self, x)
+
     def train_on_batch(self, x, y, class_weight=None,
                        sample_weight=None):
         """Single gradient update over one batch of samples.
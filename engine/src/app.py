@@ -7,11 +7,8 @@ import chess
 import chess.engine
 import json
 import tempfile
-import numpy
 
 from enum import Enum
-from keras.models import load_model
-from sunnfish.sunfish import piece_map
 
 class Engine(Enum):
     
@@ -40,15 +37,6 @@ engine_map = {
     'Lighthouse': Engine.lighthouse
 }
 
-def fen_to_input(fen):
-    r = []
-    p = fen.split()
-    for x in p[0].replace('/', ""):
-        if x.isnumeric():
-            for _ in range(int(x)): r += piece_map['.']
-        else: r += piece_map[x]
-    return r + ([ 1, 0 ] if p[1] == 'b' else [ 0, 1 ])
-
 def args():
 
     parser = argparse.ArgumentParser()
@@ -78,6 +66,7 @@ def args():
     enginegame.add_argument("--black-engine-time-limit", type = float, default = None, help = "optional; time limit for black per move in seconds; defaults to the engine default")
     enginegame.add_argument("--output-directory", type = str, default = "", help = "optional; path to output directory where results.json will be written; otherwise IEXEC_OUT environment variable will be used")
     enginegame.add_argument("--ply-limit", type = int, default = 200, help = "optional; maximum number of plies to allow before exiting")
+    enginegame.add_argument("--ponder", action = "store_true", default = False, help = "optional; if specified, both engines think on the opponent's time")
     enginegame.set_defaults(func = engine_game)
 
     return parser.parse_args()
@@ -103,15 +92,29 @@ def main():
     )
     model_directory = tempfile.TemporaryDirectory()
     os.system("tar xfvz %s -C %s" % (nn_model, model_directory.name))
+    nn_backend = os.environ.get("NN_BACKEND", "keras")
+    ### popen_uci starts the engines with env_map alone, so the search settings of the app are passed on
+    nn_settings = { x: os.environ[x] for x in [ "NN_BATCH", "NN_CACHE_MB", "HASH_MB" ] if x in os.environ }
     env_map = {
-        "Foghorn": { "NN_MODEL": os.path.join(model_directory.name, "foghorn.h5") },
-        "Lighthouse": { "NN_CONV": "t", "NN_MODEL": os.path.join(model_directory.name, "lighthouse.h5") }
+        "Foghorn": { "NN_BACKEND": nn_backend, "NN_MODEL": os.path.join(model_directory.name, "foghorn.h5"), **nn_settings },
+        "Lighthouse": { "NN_BACKEND": nn_backend, "NN_CONV": "t", "NN_MODEL": os.path.join(model_directory.name, "lighthouse.h5"), **nn_settings }
     }
     cargs = args()
     cargs.func(cargs, env_map)
     model_directory.cleanup()
     return 0
 
+def map_models(env_map, engines):
+
+    ### the NumPy backends map a weight file exported once, shared by all engine processes;
+    ### only done for the engines in use, so that the other ones start without loading nnet
+    for x in engines:
+        env = env_map.get(x.value, {})
+        if env.get("NN_BACKEND", "keras") != "keras" and env["NN_MODEL"].endswith(".h5") and os.path.exists(env["NN_MODEL"]):
+            from sunnfish import nnet
+            nnet.export_mapped(env["NN_MODEL"], env["NN_MODEL"][:-len(".h5")] + ".nnw")
+            env["NN_MODEL"] = env["NN_MODEL"][:-len(".h5")] + ".nnw"
+
 def evaluate(cargs, env_map):
 
     ### read JSON input if provided; JSON parameters override any command line parameters.
@@ -131,17 +134,20 @@ def evaluate(cargs, env_map):
 
     ### loop through the requested engines
     if cargs.engine is None: cargs.engine = [ Engine.stockfish ]
+    map_models(env_map, cargs.engine)
     result = {}
     for x in cargs.engine:
         r, b = run(cargs, binary_map[x.value], env_map[x.value] if x.value in env_map else {})
         result[x.value] = r
+        ### the networks are only imported by the engines that use them
+        if x in (Engine.foghorn, Engine.lighthouse):
+            from sunnfish import nnet
         if x == Engine.foghorn:
-            model = load_model(env_map[x.value]["NN_MODEL"])
-            result[x.value][0]["nn_output"] = model.predict([ numpy.array([ fen_to_input(b.fen()) ]) ]).tolist()
+            model = nnet.load_model(env_map[x.value]["NN_MODEL"], env_map[x.value]["NN_BACKEND"])
+            result[x.value][0]["nn_output"] = model.predict(nnet.inputs(nnet.encode_fen([ b.fen() ]))).tolist()
         elif x == Engine.lighthouse:
-            model = load_model(env_map[x.value]["NN_MODEL"])
-            i = fen_to_input(b.fen())
-            result[x.value][0]["nn_output"] = model.predict([ numpy.array([ i ]), numpy.array([ i[:768] ]), numpy.array([ i[768:] ]) ]).tolist()
+            model = nnet.load_model(env_map[x.value]["NN_MODEL"], env_map[x.value]["NN_BACKEND"])
+            result[x.value][0]["nn_output"] = model.predict(nnet.inputs(nnet.encode_fen([ b.fen() ]), conv=True)).tolist()
     if cargs.start_position is not None: result["position"] = " ".join(cargs.start_position)
     result = json.dumps(result)
 
@@ -165,14 +171,16 @@ def run(cargs, engineB, env = {}):
         elif cargs.san_moves is not None:
             for move in cargs.san_moves:
                 board.push_san(move)
-        analysis = engine.analyse(board, chess.engine.Limit(time = cargs.time_limit, depth = cargs.depth), multipv = None if "RubiChess" in engineB or "igel" in engineB or "/sunnfish/uci.py" in engineB else cargs.pv_count)
-    if "RubiChess" in engineB or "igel" in engineB or "/sunnfish/uci.py" in engineB: analysis = [ analysis ]
+        analysis = engine.analyse(board, chess.engine.Limit(time = cargs.time_limit, depth = cargs.depth), multipv = None if "RubiChess" in engineB or "igel" in engineB else cargs.pv_count)
+    if "RubiChess" in engineB or "igel" in engineB: analysis = [ analysis ]
 
     ### format results
     a = [{
         "depth": x["depth"],
         "pv": " ".join([ xx.uci() for xx in x["pv"] ]) if not cargs.move_output_san else board.variation_san(x["pv"]),
-        "score": format_score(x["score"].white())
+        "score": format_score(x["score"].white()),
+        # Throughput of the search, for the engines that report it
+        **{ k: x[k] for k in ("seldepth", "nodes", "nps", "hashfull") if k in x }
     } for x in analysis ]
     for move in analysis[0]["pv"]: board.push(move)
     return a, board
@@ -189,16 +197,17 @@ def engine_game(cargs, env_map):
         board.push_san(move)
 
     # play the game
+    map_models(env_map, [ cargs.white_engine, cargs.black_engine ])
     moves = []
     with chess.engine.SimpleEngine.popen_uci(binary_map[cargs.white_engine.value], env = env_map[cargs.white_engine.value] if cargs.white_engine.value in env_map else {}) as white:
         with chess.engine.SimpleEngine.popen_uci(binary_map[cargs.black_engine.value], env = env_map[cargs.black_engine.value] if cargs.black_engine.value in env_map else {}) as black:
             while not board.is_game_over() and len(moves) < cargs.ply_limit:
                 if board.turn == chess.WHITE:
-                    move = white.play(board, chess.engine.Limit(time = cargs.white_engine_time_limit, depth = cargs.white_engine_depth)).move
+                    move = white.play(board, chess.engine.Limit(time = cargs.white_engine_time_limit, depth = cargs.white_engine_depth), ponder = cargs.ponder).move
                     moves.append(board.san(move))
                     board.push(move)
                 if not board.is_game_over():
-                    move = black.play(board, chess.engine.Limit(time = cargs.black_engine_time_limit, depth = cargs.black_engine_depth)).move
+                    move = black.play(board, chess.engine.Limit(time = cargs.black_engine_time_limit, depth = cargs.black_engine_depth), ponder = cargs.ponder).move
                     moves.append(board.san(move))
                     board.push(move)
     
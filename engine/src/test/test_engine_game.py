@@ -78,3 +78,13 @@ class TestEvaluation(unittest.TestCase):
                 self.assertEqual(j["white"], { "engine": "Stockfish", "depth": 19 })
                 self.assertEqual(j["black"], { "engine": "Foghorn", "depth": 25 })
                 self.assertIn("engine_moves", j)
+
+    def test_game_of_century_timed_foghorn_ponder(self):
+        with tempfile.TemporaryDirectory() as d:
+            mounts = RESOURCE_MOUNTS + MODEL_MOUNTS + [( d, OUTPUTS )]
+            output = os.path.join(d, "results.json")
+            self.assertEqual(exe(mounts, "--white-engine-time-limit", "2", "--black-engine-time-limit", "2", "--ply-limit", "10", "--ponder", "--opening-san", "d4", "e5", "dxe5", "--white-engine", "Stockfish", "--black-engine", "Foghorn", "--output-directory", OUTPUTS), 0)
+            self.assertEqual(os.path.exists(output), True)
+            with open(output, 'rt') as f:
+                j = json.load(f)
+                self.assertIn("engine_moves", j)
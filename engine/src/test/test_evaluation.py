@@ -13,11 +13,13 @@ IMAGE_NAME = "chess-engine-dapp:latest"
 RESOURCE_MOUNTS = [ (os.path.join(os.path.dirname(os.path.realpath(__file__)), "resources"), INPUTS) ]
 MODEL_MOUNTS = [ (os.path.join(os.path.dirname(os.path.realpath(__file__)), "sunnfish"), MODELS) ]
 
-def exe(mounts, *args):
+def exe(mounts, *args, environment = {}):
     mountsv = []
     for x in mounts + MODEL_MOUNTS:
         mountsv += [ "--volume", x[0] + ':' + x[1] ]
     env = [ "--env", "IEXEC_IN=/model", "--env", "IEXEC_DATASET_FILENAME=light-test-models.tar.gz" ]
+    for k, v in environment.items():
+        env += [ "--env", k + '=' + v ]
     return subprocess.call([ "docker", "run" ] + env + mountsv + [ IMAGE_NAME, "evaluate" ] + list(args))
 
 class TestEvaluation(unittest.TestCase):
@@ -136,5 +138,21 @@ class TestEvaluation(unittest.TestCase):
                 j = json.load(f)
                 for _ in [ "Foghorn", "Lighthouse" ]:
                     self.assertIn("Foghorn", j)
-                    self.assertEqual(len(j["Foghorn"]), 1)
+                    self.assertEqual(len(j["Foghorn"]), 3)
                     self.assertIn("nn_output", j["Foghorn"][0])
+
+    def test_game_of_century_foghorn_light_numpy_backend(self):
+        with tempfile.TemporaryDirectory() as d:
+            mounts = RESOURCE_MOUNTS + MODEL_MOUNTS + [( d, OUTPUTS )]
+            output = os.path.join(d, "results.json")
+            self.assertEqual(exe(mounts, "--json-input", "/inputs/game-of-century.foghorn-input.json", "--output-directory", "/outputs", environment = { "NN_BACKEND": "numpy" }), 0)
+            self.assertEqual(os.path.exists(output), True)
+            with open(output, 'rt') as f:
+                j = json.load(f)
+                # Lighthouse runs the convolutions of the NumPy backend
+                for engine in [ "Foghorn", "Lighthouse" ]:
+                    self.assertIn(engine, j)
+                    self.assertEqual(len(j[engine]), 3)
+                    self.assertIn("nn_output", j[engine][0])
+                    self.assertEqual(len(j[engine][0]["nn_output"][0]), 7)
+                    self.assertAlmostEqual(sum(j[engine][0]["nn_output"][0]), 1, places = 4)
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import unittest
+
+# Unlike the other tests this one runs the move generators directly, without docker
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "sunnfish"))
+
+import tools
+import bitboard
+
+DEPTHS = [ 2, 3 ]
+
+class TestPerft(unittest.TestCase):
+
+    def assertPerftCounts(self, convert = None):
+        for depth in DEPTHS:
+            for fen, nodes, expected, _seconds in tools.perft_suite(depth, convert = convert):
+                with self.subTest(fen = fen, depth = depth):
+                    self.assertEqual(nodes, expected)
+
+    def test_perft_sunfish(self):
+        self.assertPerftCounts()
+
+    def test_perft_bitboard(self):
+        self.assertPerftCounts(bitboard.from_position)
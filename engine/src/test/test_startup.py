@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+import os
+import unittest
+import subprocess
+
+MODELS = "/model"
+IMAGE_NAME = "chess-engine-dapp:latest"
+MODEL_MOUNTS = [ (os.path.join(os.path.dirname(os.path.realpath(__file__)), "sunnfish"), MODELS) ]
+
+def docker(mounts, *args, entrypoint = None):
+    mountsv = []
+    for x in mounts + MODEL_MOUNTS:
+        mountsv += [ "--volume", x[0] + ':' + x[1] ]
+    env = [ "--env", "IEXEC_IN=/model", "--env", "IEXEC_DATASET_FILENAME=light-test-models.tar.gz" ]
+    return [ "docker", "run", "-i" ] + ([ "--entrypoint", entrypoint ] if entrypoint else []) + env + mountsv + [ IMAGE_NAME ] + list(args)
+
+def uci(script, *commands):
+    ''' Output lines of the engine started by script, up to the reply to the last command '''
+    with subprocess.Popen(docker([], "-c", script, entrypoint = "/bin/sh"), stdin = subprocess.PIPE, stdout = subprocess.PIPE, text = True) as engine:
+        engine.stdin.write("".join(c + "\n" for c in commands))
+        engine.stdin.flush()
+        lines = []
+        for line in engine.stdout:
+            lines.append(line.strip())
+            if line.strip() in ("uciok", "readyok"):
+                break
+        engine.stdin.write("quit\n")
+        engine.stdin.flush()
+    return lines
+
+class TestStartup(unittest.TestCase):
+
+    def test_foghorn_uciok_before_loading_the_network(self):
+        # Every iExec task is a cold start, so uci is answered before Keras is imported
+        # and the network loaded. With a model that does not exist, only loading fails.
+        lines = uci("NN_MODEL=/tmp/missing.h5 exec python3 /sunnfish/uci.py", "uci")
+        self.assertEqual(lines[-1], "uciok")
+
+    def test_foghorn_isready_after_loading_the_network(self):
+        script = "tar xzf /model/light-test-models.tar.gz -C /tmp && NN_MODEL=/tmp/foghorn.h5 exec python3 /sunnfish/uci.py"
+        lines = uci(script, "uci", "isready")
+        self.assertEqual(lines[-1], "readyok")
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import random
+import sys
+import time
+
+import sunfish
+import tools
+from sunfish import A1, H1, A8, H8, N, S, pst
+
+from tools import WHITE, BLACK
+
+################################################################################
+# A bitboard backed drop-in for sunfish.Position.
+#
+# Pieces are kept as twelve 64 bit integers in absolute coordinates (a1 = 0,
+# h8 = 63), split into the side to move and the opponent. Moves, ep and kp are
+# still given as indices on the 120 char board of the side to move, so Searcher
+# and tools.py can use either representation. Rotating is a swap of the two
+# sides instead of reversing and swapcasing a string.
+################################################################################
+
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+PIECES = 'PNBRQK'
+
+def _index(color, sq):
+    ''' Index on the 120 char board of color of the absolute square sq '''
+    rank, fil = divmod(sq, 8)
+    i = A1 + fil - 10*rank
+    return i if color == WHITE else 119 - i
+
+# INDEX[color][sq] is the 120 board index, SQUARE[color][i] the absolute square or -1
+INDEX = [ [ _index(c, sq) for sq in range(64) ] for c in (WHITE, BLACK) ]
+SQUARE = [ [ -1 ] * 120 for c in (WHITE, BLACK) ]
+for c in (WHITE, BLACK):
+    for sq in range(64):
+        SQUARE[c][INDEX[c][sq]] = sq
+
+# Empty 120 char boards for each color, see tools.get_color
+TEMPLATE = [ sunfish.initial.translate(str.maketrans('rnbqkpRNBQKP', '.' * 12)) ]
+TEMPLATE.append(TEMPLATE[WHITE][::-1])
+# Board letters of the Position.squares codes, as seen by each color
+LETTERS = [ '.' + PIECES + PIECES.lower(), '.' + PIECES.lower() + PIECES ]
+
+# Zobrist keys of the Position.squares codes on absolute squares, and of black to move.
+# Castling, ep and kp are relative to the side to move and use the sunfish tables.
+_random = random.Random(0x2545f491)
+ZOBRIST = [ [ 0 ] * 64 ] + [ [ _random.getrandbits(64) for sq in range(64) ] for code in range(12) ]
+ZOBRIST_BLACK = _random.getrandbits(64)
+
+###############################################################################
+# Attack tables
+###############################################################################
+
+def _steps(sq, steps):
+    rank, fil = divmod(sq, 8)
+    bb = 0
+    for dr, df in steps:
+        if 0 <= rank + dr < 8 and 0 <= fil + df < 8:
+            bb |= 1 << (8 * (rank + dr) + fil + df)
+    return bb
+
+KNIGHT_ATTACKS = [ _steps(sq, ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))) for sq in range(64) ]
+KING_ATTACKS = [ _steps(sq, ((0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1))) for sq in range(64) ]
+PAWN_ATTACKS = [ [ _steps(sq, ((1, -1), (1, 1))) for sq in range(64) ],
+                 [ _steps(sq, ((-1, -1), (-1, 1))) for sq in range(64) ] ]
+
+def _ray(sq, dr, df):
+    rank, fil = divmod(sq, 8)
+    bb = 0
+    while 0 <= rank + dr < 8 and 0 <= fil + df < 8:
+        rank, fil = rank + dr, fil + df
+        bb |= 1 << (8 * rank + fil)
+    return bb
+
+# Rays towards higher squares stop at their lowest blocker, the others at their highest
+RAYS_UP = [ [ _ray(sq, dr, df) for sq in range(64) ] for dr, df in ((0, 1), (1, 0), (1, 1), (1, -1)) ]
+RAYS_DOWN = [ [ _ray(sq, dr, df) for sq in range(64) ] for dr, df in ((0, -1), (-1, 0), (-1, -1), (-1, 1)) ]
+ROOK_RAYS = [ (RAYS_UP[0], RAYS_UP[1]), (RAYS_DOWN[0], RAYS_DOWN[1]) ]
+BISHOP_RAYS = [ (RAYS_UP[2], RAYS_UP[3]), (RAYS_DOWN[2], RAYS_DOWN[3]) ]
+
+def slider_attacks(sq, occ, rays):
+    ''' Squares attacked from sq along rays, up to and including the first blocker '''
+    (up1, up2), (down1, down2) = rays
+    attacks = 0
+    for ray in (up1, up2):
+        r = ray[sq]
+        blockers = r & occ
+        if blockers:
+            r ^= ray[(blockers & -blockers).bit_length() - 1]
+        attacks |= r
+    for ray in (down1, down2):
+        r = ray[sq]
+        blockers = r & occ
+        if blockers:
+            r ^= ray[blockers.bit_length() - 1]
+        attacks |= r
+    return attacks
+
+def bits(bb):
+    ''' Yields the squares set in bb, lowest first '''
+    while bb:
+        b = bb & -bb
+        yield b.bit_length() - 1
+        bb ^= b
+
+# Squares strictly between a corner rook and the king, by color and king index.
+# Like sunfish, castling needs at least one square between the king and the rook.
+def _between(color, a, b):
+    return sum(1 << SQUARE[color][i] for i in range(min(a, b)+1, max(a, b)))
+CASTLE_WEST = [ { k: _between(c, A1, k) for k in range(A1+2, H1+1) } for c in (WHITE, BLACK) ]
+CASTLE_EAST = [ { k: _between(c, H1, k) for k in range(A1, H1-1) } for c in (WHITE, BLACK) ]
+
+###############################################################################
+# Positions
+###############################################################################
+
+class Position:
+    """ A state of a chess game, with the same interface as sunfish.Position
+    us -- bitboards of the side to move, by piece
+    them -- bitboards of the opponent, by piece
+    color -- the color of the side to move
+    squares -- 64 bytes, 0 for empty squares, else 1 + piece + 6*color of the piece
+    score, wc, bc, ep, kp -- as in sunfish.Position
+    zb -- Zobrist key of the squares
+    """
+
+    __slots__ = ('us', 'them', 'color', 'squares', 'score', 'wc', 'bc', 'ep', 'kp', 'zb', '_board')
+
+    # Bitboard positions are not evaluated incrementally
+    acc = None
+
+    def __init__(self, us, them, color, squares, score, wc, bc, ep, kp, zb):
+        self.us, self.them, self.color, self.squares = us, them, color, squares
+        self.score, self.wc, self.bc, self.ep, self.kp = score, wc, bc, ep, kp
+        self.zb = zb
+        self._board = None
+
+    @staticmethod
+    def from_position(pos):
+        ''' Converts a sunfish.Position '''
+        color = tools.get_color(pos)
+        us, them, squares = [ 0 ] * 6, [ 0 ] * 6, bytearray(64)
+        for i, p in enumerate(pos.board):
+            if p.upper() in PIECES:
+                k, sq = PIECES.index(p.upper()), SQUARE[color][i]
+                if p.isupper():
+                    us[k] |= 1 << sq
+                    squares[sq] = 1 + k + 6*color
+                else:
+                    them[k] |= 1 << sq
+                    squares[sq] = 1 + k + 6*(1-color)
+        zb = 0
+        for sq, code in enumerate(squares):
+            zb ^= ZOBRIST[code][sq]
+        return Position(tuple(us), tuple(them), color, bytes(squares), pos.score, pos.wc, pos.bc, pos.ep, pos.kp, zb)
+
+    def _key(self):
+        return (self.us, self.them, self.color, self.score, self.wc, self.bc, self.ep, self.kp)
+
+    def __eq__(self, other):
+        return isinstance(other, Position) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    @property
+    def key(self):
+        ''' 64 bit Zobrist key of the position '''
+        return self.zb ^ (ZOBRIST_BLACK if self.color else 0) ^ sunfish.ZOBRIST_CASTLING[self.wc, self.bc] \
+            ^ sunfish.ZOBRIST_EP[self.ep] ^ sunfish.ZOBRIST_KP[self.kp]
+
+    @property
+    def board(self):
+        ''' The 120 char board of sunfish.Position, built on demand '''
+        if self._board is None:
+            board = list(TEMPLATE[self.color])
+            index, letters = INDEX[self.color], LETTERS[self.color]
+            for sq, code in enumerate(self.squares):
+                if code:
+                    board[index[sq]] = letters[code]
+            self._board = ''.join(board)
+        return self._board
+
+    def piece(self, i):
+        ''' As sunfish.Position.piece, without building the board '''
+        sq = SQUARE[self.color][i]
+        return LETTERS[self.color][self.squares[sq]] if sq >= 0 else TEMPLATE[self.color][i]
+
+    def has_pieces(self):
+        ''' As sunfish.Position.has_pieces '''
+        us = self.us
+        return (us[KNIGHT] | us[BISHOP] | us[ROOK] | us[QUEEN]) != 0
+
+    def gen_moves(self, tactical=None):
+        ''' As sunfish.Position.gen_moves '''
+        us, them, color = self.us, self.them, self.color
+        index, square = INDEX[color], SQUARE[color]
+        ours = us[0] | us[1] | us[2] | us[3] | us[4] | us[5]
+        theirs = them[0] | them[1] | them[2] | them[3] | them[4] | them[5]
+        occ = ours | theirs
+        kings = 0
+        if self.kp:
+            for i in (self.kp-1, self.kp, self.kp+1):
+                if square[i] >= 0:
+                    kings |= 1 << square[i] & ~ours
+        # The squares moves may go to, besides those of our own pieces
+        allowed = ~0 if tactical is None else theirs | kings if tactical else ~(theirs | kings)
+        # Pawns, which may also capture onto the en passant and king passant squares
+        targets = theirs | kings
+        if self.ep and square[self.ep] >= 0:
+            targets |= 1 << square[self.ep] & ~ours
+        attacks = PAWN_ATTACKS[color]
+        step = 8 if color == WHITE else -8
+        for sq in bits(us[PAWN]):
+            i = index[sq]
+            to = sq + step
+            # Pushes are tactical when they promote, captures always are
+            if not occ >> to & 1 and (tactical is None or tactical == (A8 <= i+N <= H8)):
+                yield (i, i+N)
+                if i >= A1+N and not tactical and not occ >> (to + step) & 1:
+                    yield (i, i+N+N)
+            if tactical is not False:
+                for to in bits(attacks[sq] & targets):
+                    yield (i, index[to])
+        for sq in bits(us[KNIGHT]):
+            for to in bits(KNIGHT_ATTACKS[sq] & ~ours & allowed):
+                yield (index[sq], index[to])
+        for sq in bits(us[BISHOP]):
+            for to in bits(slider_attacks(sq, occ, BISHOP_RAYS) & ~ours & allowed):
+                yield (index[sq], index[to])
+        for sq in bits(us[ROOK]):
+            for to in bits(slider_attacks(sq, occ, ROOK_RAYS) & ~ours & allowed):
+                yield (index[sq], index[to])
+        for sq in bits(us[QUEEN]):
+            for to in bits((slider_attacks(sq, occ, ROOK_RAYS) | slider_attacks(sq, occ, BISHOP_RAYS)) & ~ours & allowed):
+                yield (index[sq], index[to])
+        for sq in bits(us[KING]):
+            k = index[sq]
+            for to in bits(KING_ATTACKS[sq] & ~ours & allowed):
+                yield (k, index[to])
+            # Castling, with the rook still in its corner and nothing in between
+            if tactical:
+                continue
+            if self.wc[0] and k in CASTLE_WEST[color] and us[ROOK] >> square[A1] & 1 and not occ & CASTLE_WEST[color][k]:
+                yield (k, k-2)
+            if self.wc[1] and k in CASTLE_EAST[color] and us[ROOK] >> square[H1] & 1 and not occ & CASTLE_EAST[color][k]:
+                yield (k, k+2)
+
+    def is_attacked(self, i):
+        ''' As sunfish.Position.is_attacked '''
+        sq, them = SQUARE[self.color][i], self.them
+        if sq < 0:
+            return False
+        occ = 0
+        for bb in self.us + them:
+            occ |= bb
+        # Our pieces on sq would attack the opponent pieces of the same kind that attack sq
+        return bool(PAWN_ATTACKS[self.color][sq] & them[PAWN] or KNIGHT_ATTACKS[sq] & them[KNIGHT]
+                    or KING_ATTACKS[sq] & them[KING]
+                    or slider_attacks(sq, occ, ROOK_RAYS) & (them[ROOK] | them[QUEEN])
+                    or slider_attacks(sq, occ, BISHOP_RAYS) & (them[BISHOP] | them[QUEEN]))
+
+    def in_check(self):
+        ''' As sunfish.Position.in_check '''
+        return self.is_attacked(INDEX[self.color][self.us[KING].bit_length() - 1])
+
+    def can_capture_king(self):
+        ''' As sunfish.Position.can_capture_king '''
+        pos = self.rotate()
+        if pos.kp and any(pos.is_attacked(i) for i in (pos.kp-1, pos.kp, pos.kp+1)):
+            return True
+        return pos.us[KING] != 0 and pos.in_check()
+
+    def rotate(self):
+        ''' Rotates the board, preserving enpassant '''
+        return Position(self.them, self.us, 1 - self.color, self.squares, -self.score, self.bc, self.wc,
+                        119-self.ep if self.ep else 0,
+                        119-self.kp if self.kp else 0, self.zb)
+
+    def nullmove(self):
+        ''' Like rotate, but clears ep and kp '''
+        return Position(self.them, self.us, 1 - self.color, self.squares, -self.score, self.bc, self.wc, 0, 0, self.zb), 0
+
+    def _pieces(self, i, j):
+        ''' The piece moved and the piece captured (or None) from i to j '''
+        square, color = SQUARE[self.color], self.color
+        q = self.squares[square[j]]
+        return self.squares[square[i]] - 1 - 6*color, q - 7 + 6*color if q else None
+
+    def move(self, move):
+        i, j = move
+        p, q = self._pieces(i, j)
+        square, color = SQUARE[self.color], self.color
+        us, them, squares = list(self.us), list(self.them), bytearray(self.squares)
+        wc, bc, ep, kp = self.wc, self.bc, 0, 0
+        v = self._value(i, j, p, q)
+        # Actual move
+        us[p] ^= 1 << square[i] | 1 << square[j]
+        zb = self.zb ^ ZOBRIST[1 + p + 6*color][square[i]] ^ ZOBRIST[1 + p + 6*color][square[j]]
+        if q is not None:
+            them[q] ^= 1 << square[j]
+            zb ^= ZOBRIST[squares[square[j]]][square[j]]
+        squares[square[j]] = squares[square[i]]
+        squares[square[i]] = 0
+        # Castling rights, we move the rook or capture the opponent's
+        if i == A1: wc = (False, wc[1])
+        if i == H1: wc = (wc[0], False)
+        if j == A8: bc = (bc[0], False)
+        if j == H8: bc = (False, bc[1])
+        # Castling
+        if p == KING:
+            wc = (False, False)
+            if abs(j-i) == 2:
+                kp = (i+j)//2
+                us[ROOK] ^= 1 << square[A1 if j < i else H1] | 1 << square[kp]
+                squares[square[A1 if j < i else H1]] = 0
+                squares[square[kp]] = 1 + ROOK + 6*color
+                zb ^= ZOBRIST[1 + ROOK + 6*color][square[A1 if j < i else H1]] ^ ZOBRIST[1 + ROOK + 6*color][square[kp]]
+        # Pawn promotion, double move and en passant capture
+        if p == PAWN:
+            if A8 <= j <= H8:
+                us[PAWN] ^= 1 << square[j]
+                us[QUEEN] |= 1 << square[j]
+                squares[square[j]] = 1 + QUEEN + 6*color
+                zb ^= ZOBRIST[1 + PAWN + 6*color][square[j]] ^ ZOBRIST[1 + QUEEN + 6*color][square[j]]
+            if j - i == 2*N:
+                ep = i + N
+            if j == self.ep:
+                them[PAWN] &= ~(1 << square[j+S])
+                zb ^= ZOBRIST[squares[square[j+S]]][square[j+S]]
+                squares[square[j+S]] = 0
+        # We rotate the returned position, so it's ready for the next player
+        return Position(tuple(them), tuple(us), 1 - color, bytes(squares), -(self.score + v), bc, wc,
+                        119-ep if ep else 0, 119-kp if kp else 0, zb), v
+
+    def mvv_lva(self, move):
+        ''' As sunfish.Position.mvv_lva '''
+        i, j = move
+        p, q = self._pieces(i, j)
+        if self.kp and abs(j - self.kp) < 2:
+            victim = sunfish.piece['K']
+        elif q is not None:
+            victim = sunfish.piece[PIECES[q]]
+        else:
+            victim = sunfish.piece['P'] if p == PAWN and j == self.ep else 0
+        if p == PAWN and A8 <= j <= H8:
+            victim += sunfish.piece['Q'] - sunfish.piece['P']
+        return victim * 100000 - sunfish.piece[PIECES[p]]
+
+    def value(self, move):
+        i, j = move
+        square, color = SQUARE[self.color], self.color
+        q = self.squares[square[j]]
+        return self._value(i, j, self.squares[square[i]] - 1 - 6*color, q - 7 + 6*color if q else None)
+
+    def _value(self, i, j, p, q):
+        P = PIECES[p]
+        # Actual move
+        score = pst[P][j] - pst[P][i]
+        # Capture
+        if q is not None:
+            score += pst[PIECES[q]][119-j]
+        # Castling check detection
+        if abs(j-self.kp) < 2:
+            score += pst['K'][119-j]
+        # Castling
+        if p == KING and abs(i-j) == 2:
+            score += pst['R'][(i+j)//2]
+            score -= pst['R'][A1 if j < i else H1]
+        # Special pawn stuff
+        if p == PAWN:
+            if A8 <= j <= H8:
+                score += pst['Q'][j] - pst['P'][j]
+            if j == self.ep:
+                score += pst['P'][119-(j+S)]
+        return score
+
+def from_position(pos):
+    return Position.from_position(pos)
+
+################################################################################
+# Validation
+################################################################################
+
+PERFT_POSITIONS = list(tools.PERFT_COUNTS)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'compare perft counts and speed of the string and bitboard positions')
+    parser.add_argument('--depth', type = int, default = 3, help = 'optional; perft depth; default 3')
+    args = parser.parse_args()
+
+    ok = True
+    totals = { 'string': [ 0, 0.0 ], 'bitboard': [ 0, 0.0 ] }
+    for fen in PERFT_POSITIONS:
+        pos = tools.parseFEN(fen)
+        counts = {}
+        for name, p in (('string', pos), ('bitboard', from_position(pos))):
+            start = time.time()
+            counts[name] = tools.perft(p, args.depth)
+            totals[name][0] += counts[name]
+            totals[name][1] += time.time() - start
+        ok &= counts['string'] == counts['bitboard']
+        print('{:>10} {:>10} {}'.format(counts['string'], counts['bitboard'], fen))
+    for name, (nodes, elapsed) in totals.items():
+        print('{:>8}: {} nodes in {:.2f}s, {:.0f} nps'.format(name, nodes, elapsed, nodes / elapsed))
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
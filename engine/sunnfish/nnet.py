@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import functools
+import json
+import re
+import sys
+import time
+
+import numpy
+
+################################################################################
+# This module runs the Foghorn and Lighthouse evaluation networks without Keras.
+# The weights are read out of the .h5 file written by keras.models.save_model,
+# and the forward pass is plain NumPy, so nothing here imports TensorFlow.
+################################################################################
+
+# Backends understood by load_model; keras is the default, numpy uses Network
+BACKENDS = ('keras', 'numpy')
+
+def load_model(path, backend='keras'):
+    ''' Loads the network at path with Keras or the NumPy backend '''
+    if backend == 'numpy':
+        return Network.load(path)
+    if backend != 'keras':
+        raise ValueError('Unknown network backend {}; expected one of {}'.format(backend, ', '.join(BACKENDS)))
+    from keras import models
+    model = models.load_model(path)
+    # Functional models lack the method the patched Sequential has
+    if not hasattr(model, 'predict_single'):
+        model.predict_single = functools.partial(models.predict_single, model)
+    return model
+
+################################################################################
+# Input encoding
+#
+# The input of both networks is 12 one-hot entries per square, from a8 to h1,
+# followed by two entries for black and for white to move. Boards are encoded
+# by looking their bytes up in a table and setting the ones by fancy indexing,
+# into an array the caller may preallocate and reuse.
+################################################################################
+
+# The pieces in the order of their entries within a square
+PIECES = 'pnbrqkPNBRQK'
+INPUT_SIZE = 770
+
+# The entry of each byte within its square, -1 for empty squares and others
+_ENTRIES = numpy.full(256, -1, dtype=numpy.int64)
+_ENTRIES[numpy.frombuffer(PIECES.encode('ascii'), dtype=numpy.uint8)] = numpy.arange(len(PIECES))
+
+def encode(boards, squares=None, out=None, black=None):
+    ''' The network inputs of boards, strings of the same length with the pieces of
+        the squares a8 to h1 at the indices squares, or as their only characters if
+        squares is None. They are written to the first rows of out, a float32 array
+        of INPUT_SIZE columns and at least len(boards) rows if given, and returned.
+        black tells for each board if black is to move, by default none are. '''
+    n = len(boards)
+    codes = numpy.frombuffer(''.join(boards).encode('latin-1'), dtype=numpy.uint8).reshape(n, -1)
+    entries = _ENTRIES[codes if squares is None else codes[:, squares]]
+    x = numpy.empty((n, INPUT_SIZE), dtype=numpy.float32) if out is None else out[:n]
+    x.fill(0)
+    rows, cols = numpy.nonzero(entries >= 0)
+    x[rows, cols * 12 + entries[rows, cols]] = 1
+    if black is None:
+        x[:, INPUT_SIZE-1] = 1
+    else:
+        x[numpy.arange(n), INPUT_SIZE-1 - numpy.asarray(black, dtype=numpy.int64)] = 1
+    return x
+
+def encode_fen(fens, out=None):
+    ''' As encode, for positions in Forsyth-Edwards Notation '''
+    boards = [ re.sub(r'\d', lambda m: '.' * int(m.group(0)), fen.split()[0]).replace('/', '') for fen in fens ]
+    return encode(boards, out=out, black=[ fen.split()[1] == 'b' for fen in fens ])
+
+def inputs(x, conv=False):
+    ''' The arrays to predict on for the encoded boards x. Lighthouse (conv) takes the
+        whole input, the squares and the side to move, which are views of x. '''
+    return [ x, x[:, :768], x[:, 768:] ] if conv else [ x ]
+
+################################################################################
+# Layers
+################################################################################
+
+def softmax(x):
+    e = numpy.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+def elu(x, alpha=1.0):
+    return numpy.where(x > 0, x, alpha * (numpy.exp(numpy.minimum(x, 0)) - 1))
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: numpy.maximum(x, 0),
+    'softmax': softmax,
+    'sigmoid': lambda x: 1 / (1 + numpy.exp(-x)),
+    'hard_sigmoid': lambda x: numpy.clip(0.2 * x + 0.5, 0, 1),
+    'tanh': numpy.tanh,
+    'elu': elu,
+    'selu': lambda x: 1.0507009873554805 * elu(x, 1.6732632423543772),
+    'softplus': lambda x: numpy.logaddexp(x, 0),
+    'softsign': lambda x: x / (1 + numpy.abs(x)),
+}
+
+def activation(name):
+    if name not in ACTIVATIONS:
+        raise ValueError('Unsupported activation {}'.format(name))
+    return ACTIVATIONS[name]
+
+def padding_2d(x, kernel, strides, padding, value=0):
+    ''' Pads the spatial axes of an NHWC tensor the way Keras 'same' padding does '''
+    if padding == 'valid':
+        return x
+    pads = [(0, 0)]
+    for size, k, s in zip(x.shape[1:3], kernel, strides):
+        total = max((-(-size // s) - 1) * s + k - size, 0)
+        pads.append((total // 2, total - total // 2))
+    return numpy.pad(x, pads + [(0, 0)], constant_values=value)
+
+def windows_2d(x, kernel, strides):
+    ''' (n, h, w, c) -> (n, oh, ow, c, kh, kw) view of the sliding windows. Built with
+        as_strided, as sliding_window_view needs NumPy 1.20. '''
+    n, h, w, c = x.shape
+    sn, sh, sw, sc = x.strides
+    shape = (n, (h - kernel[0]) // strides[0] + 1, (w - kernel[1]) // strides[1] + 1, c, kernel[0], kernel[1])
+    return numpy.lib.stride_tricks.as_strided(x, shape, (sn, sh * strides[0], sw * strides[1], sc, sh, sw), writeable=False)
+
+def dense(config, weights):
+    kernel = weights[0]
+    bias = weights[1] if config.get('use_bias', True) else 0
+    act = activation(config.get('activation', 'linear'))
+    return lambda x: act(x @ kernel + bias)
+
+def conv2d(config, weights):
+    kernel = weights[0]
+    bias = weights[1] if config.get('use_bias', True) else 0
+    act = activation(config.get('activation', 'linear'))
+    size, strides = kernel.shape[:2], tuple(config.get('strides', (1, 1)))
+    if tuple(config.get('dilation_rate', (1, 1))) != (1, 1):
+        raise ValueError('Dilated convolutions are not supported')
+    def f(x):
+        w = windows_2d(padding_2d(x, size, strides, config.get('padding', 'valid')), size, strides)
+        return act(numpy.tensordot(w, kernel, axes=([3, 4, 5], [2, 0, 1])) + bias)
+    return f
+
+def pooling_2d(reduce, pad_value):
+    def build(config, weights):
+        size = tuple(config.get('pool_size', (2, 2)))
+        strides = tuple(config.get('strides') or size)
+        return lambda x: reduce(windows_2d(padding_2d(x, size, strides, config.get('padding', 'valid'), pad_value), size, strides), axis=(4, 5))
+    return build
+
+def batch_normalization(config, weights):
+    weights = list(weights)
+    gamma = weights.pop(0) if config.get('scale', True) else 1
+    beta = weights.pop(0) if config.get('center', True) else 0
+    mean, variance = weights
+    # Folded into x * scale + shift
+    scale = gamma / numpy.sqrt(variance + config.get('epsilon', 1e-3))
+    shift = beta - mean * scale
+    axis = config.get('axis', -1)
+    axis = axis[0] if isinstance(axis, list) else axis
+    def f(x):
+        shape = [1] * x.ndim
+        shape[axis] = -1
+        return x * scale.reshape(shape) + shift.reshape(shape)
+    return f
+
+def merge(reduce):
+    return lambda config, weights: lambda *xs: reduce(xs)
+
+LAYERS = {
+    'InputLayer': lambda config, weights: lambda x: x,
+    'Dense': dense,
+    'Conv2D': conv2d,
+    'Activation': lambda config, weights: activation(config['activation']),
+    'ReLU': lambda config, weights: ACTIVATIONS['relu'],
+    'Softmax': lambda config, weights: softmax,
+    'LeakyReLU': lambda config, weights: lambda x: numpy.where(x > 0, x, config.get('alpha', 0.3) * x),
+    'ELU': lambda config, weights: lambda x: elu(x, config.get('alpha', 1.0)),
+    'Flatten': lambda config, weights: lambda x: x.reshape(len(x), -1),
+    'Reshape': lambda config, weights: lambda x: x.reshape((len(x),) + tuple(config['target_shape'])),
+    'MaxPooling2D': pooling_2d(numpy.max, -numpy.inf),
+    'AveragePooling2D': pooling_2d(numpy.mean, 0),
+    'BatchNormalization': batch_normalization,
+    'Concatenate': lambda config, weights: lambda *xs: numpy.concatenate(xs, axis=config.get('axis', -1)),
+    'Add': merge(sum),
+    'Subtract': merge(lambda xs: xs[0] - xs[1]),
+    'Multiply': merge(lambda xs: numpy.prod(xs, axis=0)),
+    'Average': merge(lambda xs: sum(xs) / len(xs)),
+    'Maximum': merge(lambda xs: numpy.max(xs, axis=0)),
+    'Minimum': merge(lambda xs: numpy.min(xs, axis=0)),
+}
+
+# Layers that only act during training
+for name in ('Dropout', 'SpatialDropout2D', 'AlphaDropout', 'GaussianDropout', 'GaussianNoise', 'ActivityRegularization'):
+    LAYERS[name] = LAYERS['InputLayer']
+
+################################################################################
+# Quantization
+#
+# Kernels are rounded either to float16 or to int8 with one scale per layer, the
+# largest magnitude of the kernel mapping to 127. Biases and normalization stay
+# float32, they are few. This only measures what quantizing would cost, see the
+# quantize command: NumPy has no fast int8 or float16 matrix products, float32
+# BLAS beats them by far, so the engines keep evaluating with float32 weights.
+################################################################################
+
+QUANTIZATIONS = ('float16', 'int8')
+
+# Layers whose first weight is a kernel that gets quantized
+KERNEL_LAYERS = ('Dense', 'Conv2D')
+
+def quantize_array(w, dtype):
+    ''' (quantized w, scale) such that w is about quantized w * scale '''
+    if dtype == 'float16':
+        return w.astype(numpy.float16), 1.0
+    if dtype != 'int8':
+        raise ValueError('Unknown quantization {}; expected one of {}'.format(dtype, ', '.join(QUANTIZATIONS)))
+    scale = float(numpy.abs(w).max()) / 127 or 1.0
+    return numpy.clip(numpy.round(w / scale), -127, 127).astype(numpy.int8), scale
+
+def dequantize(q, scale):
+    return q.astype(numpy.float32) * numpy.float32(scale)
+
+################################################################################
+# Model files
+#
+# Besides the .h5 files of Keras, models can be exported to a mapped weight file:
+# a magic string, the length of a JSON header and the header, holding the Keras
+# model config and the dtype, shape and offset of the weights of each layer, then
+# the weights as float32 arrays, each starting on a page. Loading maps the file
+# and takes views of it, so it is near instant and all processes evaluating with
+# the same file share one copy of the weights in the page cache.
+################################################################################
+
+MAPPED_MAGIC = b'\x93NNWEIGHTS\x01\n'
+PAGE = 4096
+
+def _text(s):
+    return s.decode('utf8') if isinstance(s, bytes) else s
+
+def _page(offset):
+    return -(-offset // PAGE) * PAGE
+
+def read_h5(path):
+    ''' (model config, weights of each layer by name) of a model written by keras.models.save_model '''
+    import h5py
+    with h5py.File(path, 'r') as f:
+        config = json.loads(_text(f.attrs['model_config']))
+        group = f['model_weights'] if 'model_weights' in f else f
+        weights = {}
+        for name in group.attrs['layer_names']:
+            g = group[_text(name)]
+            weights[_text(name)] = [ g[_text(w)][()] for w in g.attrs['weight_names'] ]
+    return config, weights
+
+def is_mapped(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAPPED_MAGIC)) == MAPPED_MAGIC
+
+def read_mapped(path):
+    ''' As read_h5, for a file written by export_mapped. The weights are read only views of the file. '''
+    data = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+    start = len(MAPPED_MAGIC) + 8
+    size = int(data[len(MAPPED_MAGIC):start].view('<u8')[0])
+    header = json.loads(bytes(data[start:start+size]).decode('utf8'))
+    base = _page(start + size)
+    weights = { name: [ numpy.ndarray(tuple(shape), dtype=dtype, buffer=data, offset=base+offset) for dtype, shape, offset in arrays ]
+                for name, arrays in header['weights'].items() }
+    return header['config'], weights
+
+def export_mapped(source, target):
+    ''' Writes the model in the .h5 file at source to a mapped weight file at target '''
+    config, weights = read_h5(source)
+    index, arrays, end = {}, [], 0
+    for name, ws in weights.items():
+        index[name] = []
+        for w in ws:
+            index[name].append(('<f4', list(w.shape), end))
+            arrays.append((end, numpy.ascontiguousarray(w, dtype='<f4')))
+            end = _page(end + w.nbytes)
+    header = json.dumps({ 'config': config, 'weights': index }).encode('utf8')
+    base = _page(len(MAPPED_MAGIC) + 8 + len(header))
+    with open(target, 'wb') as f:
+        f.write(MAPPED_MAGIC + numpy.array([ len(header) ], dtype='<u8').tobytes() + header)
+        for offset, w in arrays:
+            f.seek(base + offset)
+            f.write(w.tobytes())
+        f.truncate(base + end)
+
+################################################################################
+# Networks
+################################################################################
+
+class Network:
+    """ A Keras model evaluated with NumPy
+
+    nodes -- (name, function, inbound names) in topological order
+    inputs -- names of the nodes fed by the inputs, in Keras input order
+    outputs -- names of the nodes whose values are returned
+    layers -- (class name, config, weights) by node name
+    first -- index of the Dense node that alone consumes the input, or None
+    """
+
+    def __init__(self, nodes, inputs, outputs, layers):
+        self.nodes = nodes
+        self.inputs = inputs
+        self.outputs = outputs
+        self.layers = layers
+        self.first = self.first_layer()
+
+    @staticmethod
+    def load(path):
+        ''' Reads the topology and weights of a model written by keras.models.save_model
+            or by export_mapped, whose weights then stay mapped from the file '''
+        return Network.from_config(*(read_mapped(path) if is_mapped(path) else read_h5(path)))
+
+    @staticmethod
+    def from_config(config, weights):
+        ''' Builds the network from a Keras model config and the weights of each layer by name '''
+        cls, config = config['class_name'], config['config']
+        if cls == 'Sequential':
+            layers = config if isinstance(config, list) else config['layers']
+            specs, previous = [], '__input__'
+            for layer in layers:
+                name = layer['config']['name']
+                specs.append((name, layer['class_name'], layer['config'], [previous]))
+                previous = name
+            inputs, outputs = ['__input__'], [previous]
+            specs.insert(0, ('__input__', 'InputLayer', {}, []))
+        elif cls in ('Model', 'Functional'):
+            specs = []
+            for layer in config['layers']:
+                if len(layer['inbound_nodes']) > 1:
+                    raise ValueError('Shared layer {} is not supported'.format(layer['name']))
+                inbound = [ node[0] for node in layer['inbound_nodes'][0] ] if layer['inbound_nodes'] else []
+                specs.append((layer['name'], layer['class_name'], layer['config'], inbound))
+            inputs = [ x[0] for x in config['input_layers'] ]
+            outputs = [ x[0] for x in config['output_layers'] ]
+        else:
+            raise ValueError('Unsupported model class {}'.format(cls))
+
+        nodes, layers = [], {}
+        for name, cls, layer_config, inbound in specs:
+            if cls not in LAYERS:
+                raise ValueError('Unsupported layer {} ({})'.format(name, cls))
+            w = weights.get(name, [])
+            layers[name] = (cls, layer_config, w)
+            nodes.append((name, LAYERS[cls](layer_config, w), inbound))
+        return Network(nodes, inputs, outputs, layers)
+
+    def quantize(self, dtype):
+        ''' A copy of the network with its kernels rounded to dtype and back to float32,
+            to measure the error of quantize_array '''
+        nodes, layers = [], {}
+        for name, f, inbound in self.nodes:
+            cls, config, weights = self.layers[name]
+            if cls in KERNEL_LAYERS:
+                weights = [ dequantize(*quantize_array(weights[0], dtype)) ] + weights[1:]
+                f = LAYERS[cls](config, weights)
+            layers[name] = (cls, config, weights)
+            nodes.append((name, f, inbound))
+        return Network(nodes, self.inputs, self.outputs, layers)
+
+    def weight_bytes(self, dtype=None):
+        ''' Size of the weights, with the kernels quantized to dtype if given '''
+        size = { 'float16': 2, 'int8': 1 }.get(dtype, 4)
+        return sum(w.size * (size if cls in KERNEL_LAYERS and k == 0 else 4)
+                   for cls, config, weights in self.layers.values() for k, w in enumerate(weights))
+
+    def predict(self, x, batch_size=None, verbose=0, steps=None):
+        ''' Same contract as keras Model.predict: one array per model input, batch first '''
+        if not isinstance(x, (list, tuple)):
+            x = [ x ]
+        if len(x) != len(self.inputs):
+            raise ValueError('Expected {} inputs, got {}'.format(len(self.inputs), len(x)))
+        values = { name: numpy.asarray(v, dtype=numpy.float32) for name, v in zip(self.inputs, x) }
+        for name, f, inbound in self.nodes:
+            if inbound:
+                values[name] = f(*[ values[i] for i in inbound ])
+        outputs = [ values[name] for name in self.outputs ]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    predict_on_batch = predict
+    # The Keras models of load_model run single positions faster with it, see patches/models.py
+    predict_single = predict
+
+    def first_layer(self):
+        ''' Index of the Dense layer that alone consumes the (single) input, or None.
+            Networks starting this way can have their first layer updated incrementally. '''
+        if len(self.inputs) != 1:
+            return None
+        source = self.inputs[0]
+        for index, (name, f, inbound) in enumerate(self.nodes):
+            consumers = [ node for node in self.nodes if source in node[2] ]
+            if len(consumers) != 1 or consumers[0][0] != name:
+                continue
+            cls = self.layers[name][0]
+            if cls == 'Dense':
+                return index
+            if LAYERS[cls] is not LAYERS['InputLayer']:
+                return None
+            source = name
+        return None
+
+    def first_layer_weights(self):
+        ''' (kernel, bias) of the first layer, see first_layer '''
+        cls, config, weights = self.layers[self.nodes[self.first][0]]
+        bias = weights[1] if config.get('use_bias', True) else numpy.zeros(weights[0].shape[1], dtype=numpy.float32)
+        return weights[0], bias
+
+    def predict_accumulated(self, accumulators):
+        ''' Output of the network given the first layer pre-activations, batch first '''
+        index = self.first
+        name = self.nodes[index][0]
+        values = { name: activation(self.layers[name][1].get('activation', 'linear'))(numpy.asarray(accumulators)) }
+        for name, f, inbound in self.nodes[index+1:]:
+            values[name] = f(*[ values[i] for i in inbound ])
+        outputs = [ values[name] for name in self.outputs ]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+################################################################################
+# Command line
+################################################################################
+
+def compare(args):
+    ''' Runs both backends on random boards and reports the largest output deviation '''
+    keras_model, numpy_model = load_model(args.model, 'keras'), load_model(args.model, 'numpy')
+    rng = numpy.random.RandomState(args.seed)
+    X = (rng.rand(args.samples, 770) < 0.04).astype(numpy.float32)
+    X[:, 768:] = [ 0, 1 ]
+    inputs = [ X, X[:, :768], X[:, 768:] ] if args.conv else [ X ]
+    timings = {}
+    outputs = {}
+    for name, model in (('keras', keras_model), ('numpy', numpy_model)):
+        start = time.time()
+        outputs[name] = numpy.concatenate([ model.predict([ i[k:k+1] for i in inputs ]) for k in range(len(X)) ])
+        timings[name] = (time.time() - start) / len(X)
+    deviation = float(numpy.abs(outputs['keras'] - outputs['numpy']).max())
+    print(json.dumps({ 'samples': len(X), 'max_deviation': deviation,
+                       'keras_ms_per_call': timings['keras'] * 1000, 'numpy_ms_per_call': timings['numpy'] * 1000 }))
+    return 0 if deviation <= args.tolerance else 1
+
+# Expected centipawns of the output classes, as sunfish.Position.CENTIPAWN_APPROX
+CENTIPAWNS = numpy.array([ -2000, -600, -100, 0, 100, 600, 2000 ], dtype=numpy.float32)
+
+def quantize(args):
+    ''' Reports the size of the model with quantized kernels and how far it is from the
+        float one on positions of random games: the largest output deviation, how often
+        both pick the same output class, and how often the same move by a one ply search. '''
+    import random
+    import sunfish
+    import tools
+    float_model = Network.load(args.model)
+    quantized_model = float_model.quantize(args.dtype)
+
+    rng, positions = random.Random(args.seed), []
+    while len(positions) < args.positions:
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        for _ in range(rng.randrange(2, 60)):
+            moves = [ m for m in pos.gen_moves() if not pos.move(m)[0].can_capture_king() ]
+            if not moves:
+                break
+            pos = pos.move(rng.choice(moves))[0]
+        else:
+            positions.append(pos)
+
+    deviation, classes, boards, agree = 0.0, 0, 0, 0
+    for pos in positions:
+        children = [ pos.move(m)[0] for m in pos.gen_moves() ]
+        x = inputs(encode([ child.board for child in children ], sunfish.SQUARES), args.conv)
+        outputs = { 'float': float_model.predict(x), 'quantized': quantized_model.predict(x) }
+        deviation = max(deviation, float(numpy.abs(outputs['float'] - outputs['quantized']).max()))
+        classes += int((outputs['float'].argmax(1) == outputs['quantized'].argmax(1)).sum())
+        boards += len(children)
+        # The children are scored for the opponent, the best move leaves them the least
+        agree += int((outputs['float'] @ CENTIPAWNS).argmin() == (outputs['quantized'] @ CENTIPAWNS).argmin())
+    print(json.dumps({ 'dtype': args.dtype, 'positions': len(positions), 'boards': boards,
+                       'weight_bytes': float_model.weight_bytes(), 'quantized_weight_bytes': float_model.weight_bytes(args.dtype),
+                       'max_deviation': deviation, 'class_agreement': classes / boards, 'move_agreement': agree / len(positions) }))
+    return 0
+
+def export(args):
+    ''' Writes the mapped weight file and reports the load times of both files '''
+    export_mapped(args.model, args.output)
+    timings = {}
+    for name, path in (('h5', args.model), ('mapped', args.output)):
+        start = time.time()
+        model = Network.load(path)
+        timings[name] = time.time() - start
+    X = (numpy.random.RandomState(0).rand(100, 770) < 0.04).astype(numpy.float32)
+    deviation = float(numpy.abs(Network.load(args.model).predict(inputs(X, args.conv)) - model.predict(inputs(X, args.conv))).max())
+    print(json.dumps({ 'h5_load_ms': timings['h5'] * 1000, 'mapped_load_ms': timings['mapped'] * 1000, 'max_deviation': deviation }))
+    return 0 if deviation == 0 else 1
+
+def latency(args):
+    ''' Times single position predictions of each backend, through predict and predict_single '''
+    import tools
+    import sunfish
+    pos = tools.parseFEN(tools.FEN_INITIAL)
+    X = numpy.zeros((1, INPUT_SIZE), dtype=numpy.float32)
+    x = inputs(encode([ pos.board ], sunfish.SQUARES, out=X), args.conv)
+    result = {}
+    for backend in args.backends:
+        model = load_model(args.model, backend)
+        for name in ('predict', 'predict_single'):
+            predict = getattr(model, name)
+            predict(x)
+            start = time.time()
+            for _ in range(args.calls):
+                predict(x)
+            result['{}_{}_us'.format(backend, name)] = (time.time() - start) / args.calls * 1e6
+    print(json.dumps(result))
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    comparison = subparsers.add_parser('compare', help = 'check the NumPy backend against Keras on random positions')
+    comparison.add_argument('model', type = str, help = 'path to the .h5 model')
+    comparison.add_argument('--conv', action = 'store_true', default = False, help = 'optional; feed the three Lighthouse inputs instead of one dense input')
+    comparison.add_argument('--samples', type = int, default = 200, help = 'optional; number of random positions; default 200')
+    comparison.add_argument('--seed', type = int, default = 0, help = 'optional; random seed; default 0')
+    comparison.add_argument('--tolerance', type = float, default = 1e-4, help = 'optional; largest accepted absolute deviation; default 1e-4')
+    comparison.set_defaults(func = compare)
+
+    quantization = subparsers.add_parser('quantize', help = 'report the size and the agreement with the float model of a model with float16 or int8 kernels')
+    quantization.add_argument('model', type = str, help = 'path to the model')
+    quantization.add_argument('--dtype', type = str, choices = QUANTIZATIONS, default = 'int8', help = 'optional; type of the kernels; default int8')
+    quantization.add_argument('--conv', action = 'store_true', default = False, help = 'optional; feed the three Lighthouse inputs instead of one dense input')
+    quantization.add_argument('--positions', type = int, default = 200, help = 'optional; number of positions from random games; default 200')
+    quantization.add_argument('--seed', type = int, default = 0, help = 'optional; random seed; default 0')
+    quantization.set_defaults(func = quantize)
+
+    exporting = subparsers.add_parser('export', help = 'write a model to a weight file that evaluators map instead of reading')
+    exporting.add_argument('model', type = str, help = 'path to the .h5 model')
+    exporting.add_argument('output', type = str, help = 'path to write the mapped weight file to')
+    exporting.add_argument('--conv', action = 'store_true', default = False, help = 'optional; feed the three Lighthouse inputs instead of one dense input')
+    exporting.set_defaults(func = export)
+
+    timing = subparsers.add_parser('latency', help = 'time single position predictions, through predict and predict_single')
+    timing.add_argument('model', type = str, help = 'path to the model')
+    timing.add_argument('--conv', action = 'store_true', default = False, help = 'optional; feed the three Lighthouse inputs instead of one dense input')
+    timing.add_argument('--backends', type = str, nargs = '+', choices = BACKENDS, default = [ 'keras', 'numpy' ], help = 'optional; backends to time; default keras numpy')
+    timing.add_argument('--calls', type = int, default = 2000, help = 'optional; number of predictions timed; default 2000')
+    timing.set_defaults(func = latency)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
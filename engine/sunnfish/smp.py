@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import ctypes
+import multiprocessing
+import queue
+import sys
+import time
+from multiprocessing import shared_memory
+
+import sunfish
+import tools
+
+################################################################################
+# Lazy SMP
+#
+# The main process and threads-1 helper processes all search the same root.
+# They share nothing but the transposition table, which lives in shared memory,
+# so the helpers fill it with results the main search then finds. Helpers start
+# at staggered depths to spread them over different parts of the tree.
+################################################################################
+
+# Seconds between checks that the helpers a search waits for are still alive
+POLL = 0.1
+
+def _forks():
+    # TensorFlow is not fork safe, so with Keras the helpers are spawned and load the network themselves
+    return 'fork' in multiprocessing.get_all_start_methods() and sunfish.NN_BACKEND != 'keras'
+
+def _context():
+    # Forked helpers inherit the loaded network, spawned ones load it again
+    return multiprocessing.get_context('fork' if _forks() else 'spawn')
+
+def _helper(index, name, searcher_class, backend, jobs, done, stop, nodes, depths):
+    sunfish.NN_BACKEND = backend
+    shm = shared_memory.SharedMemory(name=name)
+    searcher = searcher_class(sunfish.TranspositionTable(buffer=shm.buf))
+    searcher.stop = stop
+    for pos, history, timelimit, startingdepth, age, root in iter(jobs.get, None):
+        # Searcher.search moves the age on, or not, to the same age as the main process
+        searcher.tt.age, searcher.root = age, root
+        for depth, _move, _score in searcher.search(pos, history, timelimit, startingdepth):
+            nodes[index], depths[index] = searcher.nodes, depth
+            if stop.value or time.time() >= timelimit:
+                break
+        nodes[index] = searcher.nodes
+        done.put(index)
+    # The table has to let go of the shared memory before it can be closed
+    del searcher
+    shm.close()
+
+class LazySMP:
+    """ Searches with searcher in this process and threads-1 helper processes.
+    The transposition table of searcher is moved to shared memory until close().
+    Other attributes are those of searcher, except nodes, which counts all processes.
+    """
+
+    def __init__(self, searcher, threads):
+        ctx = _context()
+        # Loaded before forking, for the helpers to inherit
+        if _forks():
+            sunfish.load_model()
+        self.searcher, self.threads = searcher, threads
+        self.shm = shared_memory.SharedMemory(create=True, size=searcher.tt.size)
+        searcher.tt.attach(self.shm.buf)
+        self.stop = ctx.Value(ctypes.c_bool, False, lock=False)
+        searcher.stop = self.stop
+        # Indexed by process, 0 is the main process
+        self.helper_nodes = ctx.Array(ctypes.c_longlong, threads, lock=False)
+        self.depths = ctx.Array(ctypes.c_longlong, threads, lock=False)
+        self.jobs = [ ctx.SimpleQueue() for _ in range(threads) ]
+        # A Queue, not a SimpleQueue, so waiting on it can time out
+        self.done = ctx.Queue()
+        self.helpers = [ ctx.Process(target=_helper, daemon=True,
+                                     args=(k, self.shm.name, type(searcher), sunfish.NN_BACKEND, self.jobs[k], self.done,
+                                           self.stop, self.helper_nodes, self.depths))
+                         for k in range(1, threads) ]
+        for helper in self.helpers:
+            helper.start()
+
+    def __getattr__(self, name):
+        return getattr(self.searcher, name)
+
+    @property
+    def nodes(self):
+        return self.searcher.nodes + sum(self.helper_nodes[1:])
+
+    def search(self, pos, history=(), timelimit = 10000000000, startingdepth = 1):
+        """ Like Searcher.search, but yields the deepest iteration finished by any process """
+        for depth, lines in self.search_lines(pos, history, timelimit, startingdepth):
+            move, score = lines[0]
+            yield depth, move, score
+
+    def search_lines(self, pos, history=(), timelimit = 10000000000, startingdepth = 1, multipv = 1):
+        """ Like Searcher.search_lines. The helpers search the best line only, so with
+        several lines they speed up those of this process through the table, and with
+        one line the deepest iteration finished by any process is yielded. """
+        tt, key, history = self.searcher.tt, pos.key, list(history)
+        self.stop.value = False
+        # Helpers that died, of an exception or out of memory, are left out
+        running = { k for k, helper in enumerate(self.helpers, 1) if helper.is_alive() }
+        for k in range(1, self.threads):
+            self.helper_nodes[k] = self.depths[k] = 0
+        for k in running:
+            self.jobs[k].put((pos, history, timelimit, startingdepth + k % 2, tt.age, self.searcher.root))
+        try:
+            best = 0
+            for depth, lines in self.searcher.search_lines(pos, history, timelimit, startingdepth, multipv):
+                if multipv == 1:
+                    score = lines[0][1]
+                    deepest = max(self.depths[1:], default=0)
+                    entry = tt.get(key, deepest, True) if deepest > depth else None
+                    if entry is not None:
+                        depth, score = deepest, entry.lower
+                    lines = [ (tt.get_move(key), score) ]
+                if depth > best:
+                    best = depth
+                    yield depth, lines
+        finally:
+            # The flag stays set until the next search, so callers see why the search ended
+            self.stop.value = True
+            while running:
+                try:
+                    running.discard(self.done.get(timeout=POLL))
+                except queue.Empty:
+                    running = { k for k in running if self.helpers[k-1].is_alive() }
+
+    def close(self):
+        ''' Stops the helpers and moves the table back to private memory '''
+        for jobs in self.jobs[1:]:
+            jobs.put(None)
+        for helper in self.helpers:
+            helper.join()
+        self.searcher.stop = ctypes.c_bool(False)
+        self.searcher.tt.attach(bytearray(self.shm.buf))
+        self.shm.close()
+        self.shm.unlink()
+
+################################################################################
+# Benchmark
+################################################################################
+
+def time_to_depth(threads, pos, depth):
+    ''' Seconds and nodes for a fresh searcher with threads processes to finish depth '''
+    searcher = sunfish.Searcher()
+    engine = LazySMP(searcher, threads) if threads > 1 else searcher
+    try:
+        start = time.time()
+        for sdepth, _move, _score in engine.search(pos):
+            if sdepth >= depth:
+                break
+        return time.time() - start, engine.nodes
+    finally:
+        if threads > 1:
+            engine.close()
+
+def main():
+    parser = argparse.ArgumentParser(description = 'time to depth of lazy smp searches with different numbers of processes')
+    parser.add_argument('--threads', type = int, nargs = '+', default = [ 1, 2, 4 ], help = 'optional; numbers of processes; default 1 2 4')
+    parser.add_argument('--depth', type = int, default = 6, help = 'optional; search depth; default 6')
+    parser.add_argument('--fen', type = str, default = tools.FEN_INITIAL, help = 'optional; position to search; default the initial position')
+    args = parser.parse_args()
+
+    pos = tools.parseFEN(args.fen)
+    base = None
+    for threads in args.threads:
+        elapsed, nodes = time_to_depth(threads, pos, args.depth)
+        base = base or elapsed
+        print('{:>3} threads: depth {} in {:.2f}s, {} nodes, {:.0f} nps, speedup {:.2f}'.format(
+            threads, args.depth, elapsed, nodes, nodes / elapsed, base / elapsed))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
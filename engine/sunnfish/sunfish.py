@@ -2,15 +2,24 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-import re, sys, time, os
+import re, sys, time, os, random, ctypes
+from functools import partial
 from itertools import count
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 import numpy
-from keras.models import load_model
 
+try:
+    from . import nnet
+except ImportError:
+    import nnet
 
-model = load_model(os.environ["NN_MODEL"]) if "NN_MODEL" in os.environ else None
+
+# The network backend is 'keras' or 'numpy', see nnet.load_model
+NN_BACKEND = os.environ.get("NN_BACKEND", "keras")
+NN_MODEL = os.environ.get("NN_MODEL")
+# The network of NN_MODEL, loaded by the first search, see load_model
+model = None
 
 ###############################################################################
 # Piece-Square tables. Tune these to change sunfish's behaviour
@@ -101,6 +110,8 @@ piece_map_c = {
 # Our board is represented as a 120 character string. The padding allows for
 # fast detection of moves that don't stay within the board.
 A1, H1, A8, H8 = 91, 98, 21, 28
+# The indices of the squares, a8 to h1, as the network inputs have them
+SQUARES = numpy.array([ i for i in range(A8, H1+1) if 1 <= i % 10 <= 8 ])
 initial = (
     '         \n'  #   0 -  9
     '         \n'  #  10 - 19
@@ -127,28 +138,77 @@ directions = {
     'K': (N, E, S, W, N+E, S+E, S+W, N+W)
 }
 
+# Zobrist keys. ZOBRIST[p][i] is for piece p on square i and ZOBRIST_ROTATED[p][i]
+# is the key of the same piece on the rotated board, so positions can keep the key
+# of their own and of their rotated board up to date at the same time.
+_random = random.Random(0x5f3759df)
+ZOBRIST = { p: [ _random.getrandbits(64) for _ in range(120) ] for p in piece_map_c }
+ZOBRIST_ROTATED = { p: [ ZOBRIST[p.swapcase()][119-i] for i in range(120) ] for p in piece_map_c }
+ZOBRIST_CASTLING = { (wc, bc): _random.getrandbits(64)
+                     for wc in ((a, b) for a in (False, True) for b in (False, True))
+                     for bc in ((a, b) for a in (False, True) for b in (False, True)) }
+ZOBRIST_EP = [ 0 ] + [ _random.getrandbits(64) for _ in range(119) ]
+ZOBRIST_KP = [ 0 ] + [ _random.getrandbits(64) for _ in range(119) ]
+
+def zobrist(board):
+    ''' The board keys of board and of the rotated board '''
+    pieces = [ (i, p) for i, p in enumerate(board) if p in piece_map_c ]
+    key = rkey = 0
+    for i, p in pieces:
+        key ^= ZOBRIST[p][i]
+        rkey ^= ZOBRIST_ROTATED[p][i]
+    return key, rkey
+
 # Mate value must be greater than 8*queen + 2*(rook+knight+bishop)
 # King value is set to twice this value such that if the opponent is
 # 8 queens up, but we got the king, we still exceed MATE_VALUE.
-# When a MATE is detected, we'll set the score to MATE_UPPER - plies to get there
-# E.g. Mate in 3 will be MATE_UPPER - 6
+# When a MATE is detected, we'll set the score to MATE_UPPER - plies to get there,
+# counting the plies to the capture of the king. E.g. Mate in 3 will be MATE_UPPER - 7
 MATE_LOWER = piece['K'] - 10*piece['Q']
 MATE_UPPER = piece['K'] + 10*piece['Q']
 
-# The table size is the maximum number of elements in the transposition table.
-TABLE_SIZE = 1e7
+def mate_to_table(score, ply):
+    ''' Mate scores are kept in the table counting the plies from the node, not the root '''
+    return min(score + ply, MATE_UPPER) if score >= MATE_LOWER else max(score - ply, -MATE_UPPER) if score <= -MATE_LOWER else score
+
+def mate_from_table(score, ply):
+    return score - ply if score >= MATE_LOWER else score + ply if score <= -MATE_LOWER else score
+
+def mate_in(score):
+    ''' Moves to mate for a mate score, negative when getting mated '''
+    moves = (MATE_UPPER - abs(score) - 1) // 2
+    return moves if score > 0 else -moves
+
+# Megabytes of memory for the transposition table
+HASH_MB = int(os.environ.get("HASH_MB", 64))
 
 # Constants for tuning search
 QS_LIMIT = 1000
 EVAL_ROUGHNESS = 13
 DRAW_TEST = True
 
+# Leaf positions scored by the network in a single call. With a batch size of
+# one every quiet leaf costs its own predict round trip. Larger batches take the
+# next leaves of the same frontier node along, which only pays when a predict
+# call has a high fixed cost, like the Keras one. So Keras batches by default,
+# NumPy, whose calls cost little over the positions they score, does not.
+NN_BATCH = int(os.environ.get("NN_BATCH", 8 if NN_BACKEND == "keras" else 1))
+# Lighthouse networks take the input split in squares and side to move besides the whole
+NN_CONV = os.environ.get("NN_CONV") is not None
+# Memory, in megabytes, for network scores kept between searches.
+NN_CACHE_MB = int(os.environ.get("NN_CACHE_MB", 64))
+# Update the first network layer move by move when the network supports it and the
+# layer is at least NN_ACCUMULATE_WIDTH wide. Narrower layers are as fast or faster
+# to compute from scratch than the updates are to keep up at every node.
+NN_ACCUMULATE = os.environ.get("NN_ACCUMULATE", "1") != "0"
+NN_ACCUMULATE_WIDTH = int(os.environ.get("NN_ACCUMULATE_WIDTH", 256))
+
 
 ###############################################################################
 # Chess logic
 ###############################################################################
 
-class Position(namedtuple('Position', 'board score wc bc ep kp')):
+class Position(namedtuple('Position', 'board score wc bc ep kp zb acc', defaults=(None, None))):
     """ A state of a chess game
     board -- a 120 char representation of the board
     score -- the board evaluation
@@ -156,36 +216,48 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
     bc -- the opponent castling rights, [west/king side, east/queen side]
     ep - the en passant square
     kp - the king passant square
+    zb - Zobrist keys of the board and the rotated board, see zobrist. If None, key
+          hashes the whole board at every use, so positions are built with them.
+    acc - first layer pre-activations for the board and the rotated board, or None
     """
 
-    N = numpy.array([[ 0 for _ in range(769) ] + [ 1 ]])
+    # The keys and accumulators are derived from the board, so they take no part in comparisons
+    def __eq__(self, other):
+        return self[:6] == other[:6]
+
+    def __ne__(self, other):
+        return self[:6] != other[:6]
+
+    def __hash__(self):
+        return self.key
+
+    @property
+    def key(self):
+        ''' 64 bit Zobrist key of the position, used by the transposition tables '''
+        zb = self.zb or zobrist(self.board)
+        return zb[0] ^ ZOBRIST_CASTLING[self.wc, self.bc] ^ ZOBRIST_EP[self.ep] ^ ZOBRIST_KP[self.kp]
+
+    # The input of to_input_tensor, encoded in place for every call
+    N = numpy.zeros((1, nnet.INPUT_SIZE), dtype=numpy.float32)
     CENTIPAWN_APPROX = [ -2000, -600, -100, 0, 100, 600, 2000 ]
 
     @staticmethod
     def output_to_centipawn_approx(output):
-        return sum([ x * Position.CENTIPAWN_APPROX[i] for i, x in enumerate(output) ])
+        return int(round(sum([ x * Position.CENTIPAWN_APPROX[i] for i, x in enumerate(output) ])))
 
     @staticmethod
-    def to_input_tensor_convolutional(board):
-        b = [ x for x in board.split("\n") if len(x.strip()) > 0 ]
-        b = "".join(b).replace(" ", "")
-        for i in range(769): Position.N[0][i] = 0
-        for i, x in enumerate(b):
-            if x != '.': Position.N[0][i * 12 + piece_map_c[x]] = 1
-        return [ Position.N, Position.N[:,:768], Position.N[:,768:] ]
+    def to_input_tensor(board):
+        ''' The network input of a single board, in Position.N '''
+        return nnet.inputs(nnet.encode([ board ], SQUARES, out=Position.N), NN_CONV)
 
     @staticmethod
-    def to_input_tensor_dense(board):
-        b = [ x for x in board.split("\n") if len(x.strip()) > 0 ]
-        b = "".join(b).replace(" ", "")
-        for i in range(769): Position.N[0][i] = 0
-        for i, x in enumerate(b):
-            if x != '.': Position.N[0][i * 12 + piece_map_c[x]] = 1
-        return [ Position.N ]
+    def to_input_batch(boards, out=None):
+        ''' The network input of several boards for a single predict call, in out if given '''
+        return nnet.inputs(nnet.encode(boards, SQUARES, out=out), NN_CONV)
 
-    to_input_tensor = to_input_tensor_convolutional if os.environ.get("NN_CONV") is not None else to_input_tensor_dense
-
-    def gen_moves(self):
+    def gen_moves(self, tactical=None):
+        ''' The pseudo legal moves, or with tactical True only the captures, promotions and
+            moves onto the king passant squares, and with tactical False only the others '''
         # For each of our pieces, iterate through each possible 'ray' of moves,
         # as defined in the 'directions' map. The rays are broken e.g. by
         # captures or immediately in case of pieces such as knights.
@@ -202,25 +274,70 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
                     if p == 'P' and d in (N+W, N+E) and q == '.' \
                             and j not in (self.ep, self.kp, self.kp-1, self.kp+1): break
                     # Move it
-                    yield (i, j)
+                    if tactical is None or tactical == (q != '.' or p == 'P' and (A8 <= j <= H8 or j == self.ep)
+                                                        or self.kp and abs(j - self.kp) < 2):
+                        yield (i, j)
                     # Stop crawlers from sliding, and sliding after captures
                     if p in 'PNK' or q.islower(): break
                     # Castling, by sliding the rook next to the king
+                    if tactical: continue
                     if i == A1 and self.board[j+E] == 'K' and self.wc[0]: yield (j+E, j+W)
                     if i == H1 and self.board[j+W] == 'K' and self.wc[1]: yield (j+W, j+E)
 
+    def is_attacked(self, i):
+        ''' Whether the opponent could capture on square i, if it was their move '''
+        board = self.board
+        if board[i+N+W] == 'p' or board[i+N+E] == 'p':
+            return True
+        if any(board[i+d] == 'n' for d in directions['N']):
+            return True
+        # Walk back along each ray to the first piece on it
+        for d in directions['K']:
+            j = i + d
+            if board[j] == 'k':
+                return True
+            while board[j] == '.':
+                j += d
+            if board[j] == 'q' or board[j] == ('r' if d in directions['R'] else 'b'):
+                return True
+        return False
+
+    def in_check(self):
+        ''' Whether the opponent could capture our king '''
+        return self.is_attacked(self.board.index('K'))
+
+    def can_capture_king(self):
+        ''' Whether we could capture the opponent king, also on the squares it just castled
+            through. That is, whether the move that led here was illegal. '''
+        pos = self.rotate()
+        if pos.kp and any(pos.is_attacked(i) for i in (pos.kp-1, pos.kp, pos.kp+1)):
+            return True
+        return 'K' in pos.board and pos.in_check()
+
+    def piece(self, i):
+        ''' The letter on square i, as seen by the side to move '''
+        return self.board[i]
+
+    def has_pieces(self):
+        ''' Whether the side to move has a piece other than pawns and the king '''
+        return any(c in self.board for c in 'RBNQ')
+
     def rotate(self):
         ''' Rotates the board, preserving enpassant '''
         return Position(
             self.board[::-1].swapcase(), -self.score, self.bc, self.wc,
             119-self.ep if self.ep else 0,
-            119-self.kp if self.kp else 0)
+            119-self.kp if self.kp else 0,
+            self.zb[::-1] if self.zb else None,
+            self.acc[::-1] if self.acc else None)
 
     def nullmove(self):
         ''' Like rotate, but clears ep and kp '''
         return Position(
             self.board[::-1].swapcase(), -self.score,
-            self.bc, self.wc, 0, 0), 0
+            self.bc, self.wc, 0, 0,
+            self.zb[::-1] if self.zb else None,
+            self.acc[::-1] if self.acc else None), 0
 
     def move(self, move):
         i, j = move
@@ -254,8 +371,44 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
                 ep = i + N
             if j == self.ep:
                 board = put(board, j+S, '.')
+        # Keys and accumulators follow the pieces that changed
+        removed, added = self.changes(move)
+        key, rkey = self.zb or zobrist(self.board)
+        for k, x in removed + added:
+            key ^= ZOBRIST[x][k]
+            rkey ^= ZOBRIST_ROTATED[x][k]
+        acc = accumulator.move(self.acc, removed, added) if self.acc else None
         # We rotate the returned position, so it's ready for the next player
-        return Position(board, score, wc, bc, ep, kp).rotate(), v
+        return Position(board, score, wc, bc, ep, kp, (key, rkey), acc).rotate(), v
+
+    def changes(self, move):
+        ''' The (square, piece) pairs move takes off the board and puts on it '''
+        i, j = move
+        p, q = self.board[i], self.board[j]
+        removed, added = [ (i, p) ], [ (j, 'Q' if p == 'P' and A8 <= j <= H8 else p) ]
+        if q != '.':
+            removed.append((j, q))
+        if p == 'K' and abs(j-i) == 2:
+            removed.append((A1 if j < i else H1, 'R'))
+            added.append(((i+j)//2, 'R'))
+        if p == 'P' and j == self.ep:
+            removed.append((j+S, 'p'))
+        return removed, added
+
+    def mvv_lva(self, move):
+        ''' Ordering key of tactical moves, most valuable victim first, then least valuable attacker '''
+        i, j = move
+        p, q = self.board[i], self.board[j]
+        if self.kp and abs(j - self.kp) < 2:
+            victim = piece['K']
+        elif q.islower():
+            victim = piece[q.upper()]
+        else:
+            # En passant
+            victim = piece['P'] if p == 'P' and j == self.ep else 0
+        if p == 'P' and A8 <= j <= H8:
+            victim += piece['Q'] - piece['P']
+        return victim * 100000 - piece[p]
 
     def value(self, move):
         i, j = move
@@ -280,6 +433,66 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
                 score += pst['P'][119-(j+S)]
         return score
 
+###############################################################################
+# Incremental network evaluation
+###############################################################################
+
+def feature(i, p):
+    ''' Index of piece p on board square i in the network input '''
+    rank, fil = divmod(i - A8, 10)
+    return (rank * 8 + fil) * 12 + piece_map_c[p]
+
+class Accumulator:
+    """ Keeps the first layer pre-activations of a network up to date move by move
+
+    A position carries a pair of them, one for its board and one for the rotated
+    board, so rotating is a swap and a move only adds and subtracts the kernel rows
+    of the two to four pieces it changes. Evaluating a leaf then only runs the
+    remaining layers, see nnet.Network.predict_accumulated.
+    """
+
+    def __init__(self, kernel, bias):
+        self.kernel = kernel
+        # The side to move is always at the bottom, so input 768 is 0 and input 769 is 1
+        self.base = bias + kernel[769]
+        squares = [ i for i, p in enumerate(initial) if not p.isspace() ]
+        self.ours = { p: { i: kernel[feature(i, p)] for i in squares } for p in piece_map_c }
+        self.theirs = { p: { i: kernel[feature(119-i, p.swapcase())] for i in squares } for p in piece_map_c }
+
+    def board(self, board):
+        ''' The accumulator pair of a board, computed from scratch '''
+        pieces = [ (i, p) for i, p in enumerate(board) if p in piece_map_c ]
+        return (self.base + sum(self.ours[p][i] for i, p in pieces),
+                self.base + sum(self.theirs[p][i] for i, p in pieces))
+
+    def move(self, acc, removed, added):
+        ''' The accumulator pair after taking removed off the board and putting added on it '''
+        ours, theirs = acc
+        for k, x in added:
+            ours, theirs = ours + self.ours[x][k], theirs + self.theirs[x][k]
+        for k, x in removed:
+            ours, theirs = ours - self.ours[x][k], theirs - self.theirs[x][k]
+        return ours, theirs
+
+def set_model(m):
+    ''' Switches the network, evaluating incrementally when the network allows it '''
+    global model, accumulator
+    model = m
+    accumulator = Accumulator(*model.first_layer_weights()) \
+        if NN_ACCUMULATE and getattr(model, 'first', None) is not None \
+        and model.first_layer_weights()[0].shape[1] >= NN_ACCUMULATE_WIDTH else None
+
+set_model(model)
+_model_loaded = NN_MODEL is None
+
+def load_model(reload=False):
+    ''' Loads the network of NN_MODEL with NN_BACKEND, unless it is loaded already.
+        Keras takes seconds to import, which starting up and answering uci should not wait for. '''
+    global _model_loaded
+    if NN_MODEL is not None and (reload or not _model_loaded):
+        set_model(nnet.load_model(NN_MODEL, NN_BACKEND))
+    _model_loaded = True
+
 ###############################################################################
 # Search logic
 ###############################################################################
@@ -287,31 +500,372 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
 # lower <= s(pos) <= upper
 Entry = namedtuple('Entry', 'lower upper')
 
-class Searcher:
+class EvalCache:
+    """ Network scores by board, evicting the least recently used once the memory cap is hit """
+
+    # Approximate bytes per entry: the 120 char board, the score and the ordered dict link
+    ENTRY_SIZE = 320
+
+    def __init__(self, megabytes=NN_CACHE_MB):
+        self.scores = OrderedDict()
+        self.resize(megabytes)
+        self.hits = self.misses = 0
+
+    def resize(self, megabytes):
+        self.capacity = int(megabytes * 2**20) // EvalCache.ENTRY_SIZE
+        while len(self.scores) > self.capacity:
+            self.scores.popitem(last=False)
+
+    def get(self, board):
+        score = self.scores.get(board)
+        if score is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.scores.move_to_end(board)
+        return score
+
+    def put(self, board, score):
+        if self.capacity == 0: return
+        self.scores[board] = score
+        if len(self.scores) > self.capacity:
+            self.scores.popitem(last=False)
+
+    def clear(self):
+        self.scores.clear()
+
+    def __contains__(self, board):
+        return board in self.scores
+
+    def __len__(self):
+        return len(self.scores)
+
+# Tells TranspositionTable.put to keep the move already stored for the entry
+KEEP_MOVE = object()
+
+class TranspositionTable:
+    """ Search results in a preallocated table of buckets of 64 bit words
+    Each slot is two words, the key xor the data and the data, so a slot that was only
+    partly written reads as a different key. The data packs, from the low bits up, the
+    lower and upper bound (18 bits each, offset by MATE_UPPER), the move (14 bits, 0 for
+    none), the depth (8 bits), the root flag and the age of the search that stored it
+    (5 bits, never 0 so empty slots are all zero). The first slots of a bucket keep the
+    deepest entries of the current search, the last slot is always replaced.
+    """
+
+    BUCKET = 4
+    SLOT_SIZE = 16
+
+    def __init__(self, megabytes=HASH_MB, buffer=None):
+        self.age = 1
+        # If set, only scores stored by the current search are returned
+        self.fresh_scores = False
+        if buffer is None:
+            self.resize(megabytes)
+        else:
+            self.attach(buffer)
+
+    def resize(self, megabytes):
+        buckets = max(1, int(megabytes * 2**20) // (self.BUCKET * self.SLOT_SIZE))
+        self.attach(bytearray(buckets * self.BUCKET * self.SLOT_SIZE))
+
+    def attach(self, buffer):
+        ''' Uses buffer, for example shared memory, as the table '''
+        self.words = memoryview(buffer).cast('Q')
+        self.buckets = max(1, len(self.words) // (2*self.BUCKET))
+
+    @property
+    def size(self):
+        ''' Size of the table in bytes '''
+        return len(self.words) * 8
+
+    def clear(self):
+        data = self.words.cast('B')
+        data[:] = bytes(len(data))
+
+    def new_search(self, fresh_scores=False):
+        ''' Ages the entries of earlier searches, so they are the first to be replaced '''
+        self.age = self.age % 31 + 1
+        self.fresh_scores = fresh_scores
+
+    def _bucket(self, key):
+        return key % self.buckets * 2*self.BUCKET
+
+    def get(self, key, depth, root):
+        ''' The Entry stored for the search of key to depth, or None '''
+        words, slot = self.words, self._bucket(key)
+        ident = depth | root << 8
+        for s in range(slot, slot + 2*self.BUCKET, 2):
+            data = words[s+1]
+            if data and words[s] ^ data == key and data >> 50 & 0x1ff == ident:
+                if self.fresh_scores and data >> 59 != self.age:
+                    return None
+                return Entry((data & 0x3ffff) - MATE_UPPER, (data >> 18 & 0x3ffff) - MATE_UPPER)
+        return None
+
+    def get_move(self, key):
+        ''' The move of the deepest search of key that stored one, or None '''
+        words, slot = self.words, self._bucket(key)
+        move, best = None, -1
+        for s in range(slot, slot + 2*self.BUCKET, 2):
+            data = words[s+1]
+            if data and words[s] ^ data == key and data >> 36 & 0x3fff and data >> 50 & 0xff > best:
+                m, best = data >> 36 & 0x3fff, data >> 50 & 0xff
+                move = (m >> 7, m & 0x7f)
+        return move
+
+    def put(self, key, depth, root, entry, move=KEEP_MOVE):
+        if depth > 0xff:
+            return
+        words, slot = self.words, self._bucket(key)
+        ident = depth | root << 8
+        last = slot + 2*(self.BUCKET-1)
+        victim, priority = last, depth + 1
+        for s in range(slot, last + 2, 2):
+            data = words[s+1]
+            if data and words[s] ^ data == key and data >> 50 & 0x1ff == ident:
+                victim, priority = s, -1
+                if move is KEEP_MOVE:
+                    move = data >> 36 & 0x3fff
+                break
+            if s < last:
+                # Entries of the current search are replaced by deeper ones only
+                p = data >> 50 & 0xff if data >> 59 == self.age else -1
+                if p < priority:
+                    victim, priority = s, p
+        if move is KEEP_MOVE or move is None:
+            move = 0
+        elif type(move) is tuple:
+            move = move[0] << 7 | move[1]
+        data = entry.lower + MATE_UPPER | (entry.upper + MATE_UPPER) << 18 | move << 36 \
+            | ident << 50 | self.age << 59
+        words[victim], words[victim+1] = key ^ data, data
+
+    def hashfull(self):
+        ''' Permille of the first slots used by the current search '''
+        words = self.words
+        n = min(1000, len(words) // 2)
+        return sum(words[s] and words[s+1] >> 59 == self.age for s in range(0, 2*n, 2)) * 1000 // n
+
+class SearchStats:
+    """ Cumulative timers of the phases of a search, and counters Searcher does not keep
+    itself. They are only kept while Searcher.stats is set to one of these, otherwise each
+    phase costs the search a single check.
+    """
+
+    PHASES = ('movegen', 'move', 'predict', 'tt')
+
     def __init__(self):
-        self.tp_score = {}
-        self.tp_move = {}
+        self.seconds = dict.fromkeys(SearchStats.PHASES, 0.0)
+        self.calls = dict.fromkeys(SearchStats.PHASES, 0)
+        self.qnodes = 0
+        self.tt_probes = self.tt_hits = 0
+
+    def timed(self, phase, f, *args):
+        ''' f(*args), with the time it takes added to phase '''
+        start = time.perf_counter()
+        try:
+            return f(*args)
+        finally:
+            self.seconds[phase] += time.perf_counter() - start
+            self.calls[phase] += 1
+
+    def report(self, searcher):
+        ''' All statistics of the last search of searcher, by name '''
+        return {
+            'nodes': searcher.nodes,
+            'qnodes': self.qnodes,
+            'ttprobes': self.tt_probes,
+            'tthits': self.tt_hits,
+            'tthitrate': round(self.tt_hits / max(1, self.tt_probes), 3),
+            'cutoffs': searcher.cutoffs,
+            'firstcutoffs': searcher.first_cutoffs,
+            'firstcutoffrate': round(searcher.first_cutoffs / max(1, searcher.cutoffs), 3),
+            'nncalls': searcher.nn_calls,
+            'nnpositions': searcher.nn_positions,
+            'cachehits': searcher.nn_cache.hits,
+            'cachemisses': searcher.nn_cache.misses,
+            **{ phase + 'calls': self.calls[phase] for phase in SearchStats.PHASES },
+            **{ phase + 'time': round(self.seconds[phase], 4) for phase in SearchStats.PHASES },
+        }
+
+class TimedTable:
+    ''' The lookups and stores of a TranspositionTable, timed as the tt phase of stats '''
+
+    def __init__(self, tt, stats):
+        self.tt, self.stats = tt, stats
+
+    def get(self, key, depth, root):
+        return self.stats.timed('tt', self.tt.get, key, depth, root)
+
+    def get_move(self, key):
+        return self.stats.timed('tt', self.tt.get_move, key)
+
+    def put(self, key, depth, root, entry, move=KEEP_MOVE):
+        return self.stats.timed('tt', self.tt.put, key, depth, root, entry, move)
+
+class Searcher:
+    def __init__(self, tt=None):
+        self.tt = tt or TranspositionTable()
+        # Set to stop the search as if the time limit was hit
+        self.stop = ctypes.c_bool(False)
+        # Root moves left out of the search, for the lines after the first with multipv
+        self.excluded, self.exclusion = (), 0
         self.history = set()
+        # The root and history of the last search, whose scores a search of the same ones keeps
+        self.root = None
+        # Quiet moves that caused cutoffs, by ply for the killers and by piece and
+        # square moved to for the history scores, which are halved every iteration
+        self.killers = {}
+        self.history_scores = {}
+        # The principal variation by ply, filled by the nodes searched with pv set, and
+        # the principal variations of the lines of the last iteration
+        self.pv_table = {}
+        self.pv, self.pvs = [], []
         self.nodes = 0
+        # The deepest ply reached in the last iteration, quiescence included
+        self.seldepth = 0
+        # Called with the depth, the move and its number as each move of the root is searched
+        self.on_root_move = None
+        # Cutoffs, and those by the first move tried, as a measure of the move ordering
+        self.cutoffs = self.first_cutoffs = 0
+        self.nn_cache = EvalCache()
+        # Leaves to score along with the next one evaluate misses, see leaves, and the
+        # preallocated network input of these batches
+        self.queued = None
+        self.nn_input = numpy.zeros((NN_BATCH, nnet.INPUT_SIZE), dtype=numpy.float32)
+        self.nn_calls = 0
+        self.nn_positions = 0
+        # Set to a SearchStats to instrument the search, it is renewed with every search
+        self.stats = None
+
+    def evaluate(self, pos):
+        ''' Network evaluation of a quiet position, from the cache if it was scored before.
+            A position that is not is scored along with up to NN_BATCH-1 queued leaves. '''
+        # Without a network we play on the piece square tables alone
+        if model is None:
+            return pos.score
+        score = self.nn_cache.get(pos.board)
+        if score is None:
+            batch = { pos.board: pos }
+            # The batch is only worth it if the cache keeps the other scores
+            while self.queued is not None and len(batch) < NN_BATCH and self.nn_cache.capacity:
+                pos1 = next(self.queued, None)
+                if pos1 is None:
+                    self.queued = None
+                else:
+                    batch.setdefault(pos1.board, pos1)
+            batch = list(batch.values())
+            self.nn_calls += 1
+            self.nn_positions += len(batch)
+            if pos.acc:
+                predict, x = model.predict_accumulated, numpy.stack([ pos1.acc[0] for pos1 in batch ])
+            elif len(batch) == 1:
+                predict, x = model.predict_single, Position.to_input_tensor(pos.board)
+            else:
+                predict, x = model.predict_on_batch, Position.to_input_batch([ pos1.board for pos1 in batch ], self.nn_input)
+            outputs = predict(x) if self.stats is None else self.stats.timed('predict', predict, x)
+            for pos1, output in zip(batch, outputs):
+                self.nn_cache.put(pos1.board, Position.output_to_centipawn_approx(output))
+            score = Position.output_to_centipawn_approx(outputs[0])
+        return score
 
-    def bound(self, posx, gamma, depth, root=True, timelimit = 10000000000):
+    def staged(self, pos, depth, killer=None, ply=0):
+        ''' The moves of pos other than killer, in search order and numbered from 0.
+            Tactical moves come first, most valuable victim first, and at depth 0 they are
+            all there is: those with a high enough intrinsic score (captures and promotions).
+            Quiet moves are only generated if the search gets to them, the two killers of
+            the ply first, then by history score and by intrinsic score. '''
+        generate = lambda tactical: list(pos.gen_moves(tactical))
+        if self.stats is not None:
+            generate = partial(self.stats.timed, 'movegen', generate)
+        tactical = generate(True)
+        if depth == 0:
+            tactical = [ move for move in tactical if pos.value(move) >= QS_LIMIT ]
+        i = 0
+        for move in sorted(tactical, key=pos.mvv_lva, reverse=True):
+            if move != killer:
+                yield i, move
+                i += 1
+        if depth > 0:
+            quiet = generate(False)
+            killers = [ move for move in self.killers.get(ply, ()) if move != killer and move in quiet ]
+            piece, scores = pos.piece, self.history_scores
+            quiet.sort(key=lambda move: (scores.get((piece(move[0]), move[1]), 0), pos.value(move)), reverse=True)
+            for move in killers + [ move for move in quiet if move not in killers ]:
+                if move != killer:
+                    yield i, move
+                    i += 1
+
+    def record_cutoff(self, pos, move, depth, ply):
+        ''' Remembers move, which failed high, if it is quiet '''
+        # Only tactical moves have a victim, and hence a positive mvv_lva
+        if move is None or pos.mvv_lva(move) > 0:
+            return
+        killers = self.killers.setdefault(ply, [ None, None ])
+        if killers[0] != move:
+            killers[1], killers[0] = killers[0], move
+        index = pos.piece(move[0]), move[1]
+        self.history_scores[index] = self.history_scores.get(index, 0) + depth * depth
+
+    def leaves(self, pos, gamma, pv, ply):
+        ''' The children of pos, a node at depth 1, that will stand pat on the network, in the
+            order bound searches them. It is a generator, so the moves are only generated, and
+            the children only made, as evaluate takes them for its batches. '''
+        def stands_pat(pos1):
+            return -MATE_LOWER < pos1.score < 1-gamma and not (DRAW_TEST and pos1.key in self.history) \
+                and pos1.board not in self.nn_cache
+        if not pv and pos.has_pieces():
+            pos1 = pos.nullmove()[0]
+            if stands_pat(pos1):
+                yield pos1
+        # Children reached by a losing move stand pat on their own score
+        killer = self.tt.get_move(pos.key)
+        if killer and pos.value(killer) >= 0:
+            pos1 = pos.move(killer)[0]
+            if stands_pat(pos1):
+                yield pos1
+        for _, move in self.staged(pos, 1, killer, ply):
+            if pos.value(move) >= 0:
+                pos1 = pos.move(move)[0]
+                if stands_pat(pos1):
+                    yield pos1
+
+    def follow_pv(self, play, move, gamma, depth, timelimit, ply):
+        ''' Sets pv_table[ply] to move and the principal variation after it. The child is
+            searched unreduced, so the line goes as deep as the search did. '''
+        self.bound(play(move), 1-gamma, depth-1, root=False, timelimit = timelimit, ply=ply+1, pv=True)
+        self.pv_table[ply] = [ move ] + self.pv_table[ply+1]
+
+    def bound(self, posx, gamma, depth, root=True, timelimit = 10000000000, ply=0, pv=False):
         """ returns r where
                 s(pos) <= r < gamma    if gamma > s(pos)
-                gamma <= r <= s(pos)   if gamma <= s(pos)"""
+                gamma <= r <= s(pos)   if gamma <= s(pos)
+            With pv, the principal variation from pos is left in pv_table[ply]. """
         self.nodes += 1
+        self.seldepth = max(self.seldepth, ply)
         pos, pxvalue = posx
+        if pv:
+            self.pv_table[ply] = []
 
         # Depth <= 0 is QSearch. Here any position is searched as deeply as is needed for
         # calmness, and from this point on there is no difference in behaviour depending on
         # depth, so so there is no reason to keep different depths in the transposition table.
         depth = max(depth, 0)
 
+        # The table and the moves go through the timers of the statistics, if they are kept
+        stats, tt, play = self.stats, self.tt, pos.move
+        if stats is not None:
+            stats.qnodes += depth == 0
+            tt = TimedTable(self.tt, stats)
+            play = partial(stats.timed, 'move', pos.move)
+
         # Sunfish is a king-capture engine, so we should always check if we
         # still have a king. Notice since this is the only termination check,
         # the remaining code has to be comfortable with being mated, stalemated
         # or able to capture the opponent king.
         if pos.score <= -MATE_LOWER:
-            return -MATE_UPPER
+            return -(MATE_UPPER - ply)
 
         # We detect 3-fold captures by comparing against previously
         # _actually played_ positions.
@@ -320,59 +874,91 @@ class Searcher:
         # This is what prevents a search instability.
         # FIXME: This is not true, since other positions will be affected by
         # the new values for all the drawn positions.
+        key = pos.key
+        # Searches of the root without some moves are kept apart in the table
+        excluded = self.excluded if root else ()
+        if excluded:
+            key ^= self.exclusion
         if DRAW_TEST:
-            if not root and pos in self.history:
+            if not root and key in self.history:
                 return 0
 
         # Look in the table if we have already searched this position before.
         # We also need to be sure, that the stored search was over the same
         # nodes as the current search.
-        entry = self.tp_score.get((pos, depth, root), Entry(-MATE_UPPER, MATE_UPPER))
-        if entry.lower >= gamma and (not root or self.tp_move.get(pos) is not None):
-            return entry.lower
-        if entry.upper < gamma:
-            return entry.upper
+        entry = tt.get(key, depth, root)
+        if stats is not None:
+            stats.tt_probes += 1
+            stats.tt_hits += entry is not None
+        entry = Entry(mate_from_table(entry.lower, ply), mate_from_table(entry.upper, ply)) if entry else Entry(-MATE_UPPER, MATE_UPPER)
+        shortcut = entry.lower if entry.lower >= gamma and (not root or tt.get_move(key) is not None) \
+            else entry.upper if entry.upper < gamma else None
+        if shortcut is not None:
+            if not pv:
+                return shortcut
+            # On the principal variation we also need the line below. We follow the move of
+            # the table if it is legal, else the node is searched after all.
+            move = tt.get_move(key)
+            if move is not None and move not in excluded and not play(move)[0].can_capture_king():
+                self.follow_pv(play, move, gamma, depth, timelimit, ply)
+                return shortcut
 
         # Here extensions may be added
         # Such as 'if in_check: depth += 1'
 
+        # At the frontier, the leaves below are queued to be scored in batches as they come up
+        frontier = NN_BATCH > 1 and depth == 1 and not root and model is not None
+        if frontier:
+            queued, self.queued = self.queued, self.leaves(pos, gamma, pv, ply)
+
+        # The moves of the root are reported as they are searched
+        report, numbers = (self.on_root_move, count(1)) if root else (None, None)
+
         # Generator of moves to search in order.
         # This allows us to define the moves, but only calculate them if needed.
         def moves():
             # First try not moving at all. We only do this if there is at least one major
             # piece left on the board, since otherwise zugzwangs are too dangerous.
-            if depth > 0 and not root and any(c in pos.board for c in 'RBNQ'):
-                yield None, -self.bound(pos.nullmove(), 1-gamma, depth-3, root=False, timelimit = timelimit)
+            # Not on the principal variation though, which has to be made of real moves.
+            if depth > 0 and not root and not pv and pos.has_pieces():
+                yield None, -self.bound(pos.nullmove(), 1-gamma, depth-3, root=False, timelimit = timelimit, ply=ply+1)
             # For QSearch we have a different kind of null-move, namely we can just stop
             # and not capture anything else.
             if depth == 0:
-                yield None, pos.score if pxvalue < 0 or pos.score >= gamma else Position.output_to_centipawn_approx( model.predict(Position.to_input_tensor(pos.board))[0] )
-            # Then killer move. We search it twice, but the tp will fix things for us.
+                yield None, pos.score if pxvalue < 0 or pos.score >= gamma else self.evaluate(pos)
+            # Then killer move. It is skipped when the other moves come up.
             # Note, we don't have to check for legality, since we've already done it
             # before. Also note that in QS the killer must be a capture, otherwise we
             # will be non deterministic.
-            killer = self.tp_move.get(pos)
-            if killer and (depth > 0 or pos.value(killer) >= QS_LIMIT):
-                yield killer, -self.bound(pos.move(killer), 1-gamma, depth-1, root=False, timelimit = timelimit)
+            killer = tt.get_move(key)
+            if killer and (depth > 0 or pos.value(killer) >= QS_LIMIT) and killer not in excluded:
+                if report is not None: report(depth, killer, next(numbers))
+                yield killer, -self.bound(play(killer), 1-gamma, depth-1, root=False, timelimit = timelimit, ply=ply+1)
             # Then all the other moves
-            for i, move in enumerate(sorted(pos.gen_moves(), key=pos.value, reverse=True)):
-            #for val, move in sorted(((pos.value(move), move) for move in pos.gen_moves()), reverse=True):
-                # If depth == 0 we only try moves with high intrinsic score (captures and
-                # promotions). Otherwise we do all moves.
-                if depth > 0 or pos.value(move) >= QS_LIMIT:
-                    yield move, -self.bound(pos.move(move), 1-gamma, depth-(1 if i < 10 else 3), root=False, timelimit = timelimit)
+            for i, move in self.staged(pos, depth, killer, ply):
+                if move not in excluded:
+                    if report is not None: report(depth, move, next(numbers))
+                    yield move, -self.bound(play(move), 1-gamma, depth-(1 if i < 10 else 3), root=False, timelimit = timelimit, ply=ply+1)
 
         # Run through the moves, shortcutting when possible
-        best = -MATE_UPPER
-        for move, score in moves():
+        best, cut = -MATE_UPPER, KEEP_MOVE
+        # The real move with the best score
+        pv_move, pv_score = None, -MATE_UPPER
+        for tried, (move, score) in enumerate(moves()):
+            if move is not None and score > pv_score:
+                pv_move, pv_score = move, score
             best = max(best, score)
             if best >= gamma:
-                # Clear before setting, so we always have a value
-                if len(self.tp_move) > TABLE_SIZE: self.tp_move.clear()
                 # Save the move for pv construction and killer heuristic
-                self.tp_move[pos] = move
+                cut = move
+                self.cutoffs += 1
+                self.first_cutoffs += tried == 0
+                if depth > 0:
+                    self.record_cutoff(pos, move, depth, ply)
                 break
-            if time.time() >= timelimit: break
+            if time.time() >= timelimit or self.stop.value: break
+        if frontier:
+            self.queued = queued
 
         # Stalemate checking is a bit tricky: Say we failed low, because
         # we can't (legally) move and so the (real) score is -infty.
@@ -385,50 +971,109 @@ class Searcher:
         # but only if depth == 1, so that's probably fair enough.
         # (Btw, at depth 1 we can also mate without realizing.)
         if best < gamma and best < 0 and depth > 0:
-            is_dead = lambda pos: any(pos.value(m) >= MATE_LOWER for m in pos.gen_moves())
-            if all(is_dead(pos.move(m)[0]) for m in pos.gen_moves()):
-                in_check = is_dead(pos.nullmove()[0])
-                best = -MATE_UPPER if in_check else 0
+            if all(pos.move(m)[0].can_capture_king() for m in pos.gen_moves()):
+                # Mated, as if the king were taken two plies on
+                best = -(MATE_UPPER - ply - 2) if pos.in_check() else 0
+
+        # On the principal variation, we follow the best move to the line below it.
+        # Lines that lose the king right away are not followed, those getting mated are.
+        if pv and pv_move is not None and pv_score >= best \
+                and (pv_score > -MATE_LOWER or not play(pv_move)[0].can_capture_king()) \
+                and not (time.time() >= timelimit or self.stop.value):
+            self.follow_pv(play, pv_move, gamma, depth, timelimit, ply)
 
-        # Clear before setting, so we always have a value
-        if len(self.tp_score) > TABLE_SIZE: self.tp_score.clear()
         # Table part 2
         if best >= gamma:
-            self.tp_score[pos, depth, root] = Entry(best, entry.upper)
+            tt.put(key, depth, root, Entry(mate_to_table(best, ply), mate_to_table(entry.upper, ply)), cut)
         if best < gamma:
-            self.tp_score[pos, depth, root] = Entry(entry.lower, best)
+            tt.put(key, depth, root, Entry(mate_to_table(entry.lower, ply), mate_to_table(best, ply)))
 
         return best
 
     def search(self, pos, history=(), timelimit = 10000000000, startingdepth = 1):
         """ Iterative deepening MTD-bi search """
+        for depth, lines in self.search_lines(pos, history, timelimit, startingdepth):
+            move, score = lines[0]
+            yield depth, move, score
+
+    def search_lines(self, pos, history=(), timelimit = 10000000000, startingdepth = 1, multipv = 1):
+        """ Like search, but yields the depth and the best move and score of up to multipv
+            lines. Each line searches the root without the moves of the lines before it,
+            and they share the table below the root. """
         self.nodes = 0
-        if DRAW_TEST:
-            self.history = set(history)
-            # print('# Clearing table due to new history')
-            self.tp_score.clear()
+        self.cutoffs = self.first_cutoffs = 0
+        if self.stats is not None:
+            self.stats = SearchStats()
+        self.killers = {}
+        self.nn_calls = self.nn_positions = 0
+        self.nn_cache.hits = self.nn_cache.misses = 0
+        load_model()
+        if accumulator is not None and isinstance(pos, Position) and pos.acc is None:
+            pos = pos._replace(acc=accumulator.board(pos.board))
+        # With the draw test, scores depend on the history, so only moves outlive a search.
+        # A search of the same root and history, like the go after pondering on the position,
+        # carries on with the last one and keeps its scores.
+        history = { p.key for p in history } if DRAW_TEST else set()
+        if (pos.key, history) != self.root:
+            self.tt.new_search(fresh_scores=DRAW_TEST)
+        self.root = pos.key, set(history)
+        self.history = history
+
+        # There are no more lines than legal moves
+        if multipv > 1:
+            multipv = max(1, min(multipv, sum(not pos.move(move)[0].can_capture_king() for move in pos.gen_moves())))
 
         # In finished games, we could potentially go far enough to cause a recursion
         # limit exception. Hence we bound the ply.
         for depth in range(startingdepth, 1000):
-            # The inner loop is a binary search on the score of the position.
-            # Inv: lower <= score <= upper
-            # 'while lower != upper' would work, but play tests show a margin of 20 plays
-            # better.
-            lower, upper = -MATE_UPPER, MATE_UPPER
-            while lower < upper - EVAL_ROUGHNESS:
-                gamma = (lower+upper+1)//2
-                score = self.bound((pos, 0), gamma, depth, timelimit = timelimit)
-                if score >= gamma:
-                    lower = score
-                if score < gamma:
-                    upper = score
-            # We want to make sure the move to play hasn't been kicked out of the table,
-            # So we make another call that must always fail high and thus produce a move.
-            self.bound((pos, 0), lower, depth)
-            # If the game hasn't finished we can retrieve our move from the
-            # transposition table.
-            yield depth, self.tp_move.get(pos), self.tp_score.get((pos, depth, True)).lower
+            self.history_scores = { index: score // 2 for index, score in self.history_scores.items() if score > 1 }
+            self.seldepth = 0
+            lines, pvs = [], []
+            try:
+                for k in range(multipv):
+                    self.excluded = tuple(move for move, _ in lines)
+                    self.exclusion = hash(tuple(sorted(self.excluded))) & 0xffffffffffffffff
+                    move, score = self.mtd(pos, depth, timelimit)
+                    # A stopped iteration is incomplete, so it is not reported
+                    if self.stop.value:
+                        return
+                    # Out of moves for further lines, or left with ones losing the king
+                    if k and (move is None or score <= -MATE_LOWER or pos.move(move)[0].can_capture_king()):
+                        break
+                    lines.append((move, score))
+                    pvs.append(self.pv)
+            finally:
+                self.excluded, self.exclusion = (), 0
+            self.pv, self.pvs = pvs[0], pvs
+            yield depth, lines
+
+    def mtd(self, pos, depth, timelimit):
+        """ The best move and score of the root at depth """
+        # The inner loop is a binary search on the score of the position.
+        # Inv: lower <= score <= upper
+        # 'while lower != upper' would work, but play tests show a margin of 20 plays
+        # better.
+        # Mate scores are searched down to the ply, for the distance to the mate.
+        lower, upper = -MATE_UPPER, MATE_UPPER
+        while lower < upper - (0 if lower >= MATE_LOWER or upper <= -MATE_LOWER else EVAL_ROUGHNESS):
+            gamma = (lower+upper+1)//2
+            score = self.bound((pos, 0), gamma, depth, timelimit = timelimit)
+            if score >= gamma:
+                lower = score
+            if score < gamma:
+                upper = score
+        if self.stop.value:
+            return None, lower
+        # We want to make sure the move to play hasn't been kicked out of the table,
+        # So we make another call that must always fail high and thus produce a move.
+        # It also collects the principal variation, and gives the score, as the entry
+        # of the root may have been replaced in a small table by the time it returns.
+        score = self.bound((pos, 0), lower, depth, pv=True)
+        self.pv = self.pv_table[0]
+        # If the game hasn't finished we can retrieve our move from the
+        # transposition table.
+        key = pos.key ^ self.exclusion if self.excluded else pos.key
+        return self.tt.get_move(key), max(score, lower)
 
 
 ###############################################################################
@@ -460,7 +1105,7 @@ def print_pos(pos):
 
 
 def main():
-    hist = [Position(initial, 0, (True,True), (True,True), 0, 0)]
+    hist = [Position(initial, 0, (True,True), (True,True), 0, 0, zobrist(initial))]
     searcher = Searcher()
     while True:
         print_pos(hist[-1])
@@ -494,7 +1139,7 @@ def main():
             if time.time() - start > 1:
                 break
 
-        if score == MATE_UPPER:
+        if score >= MATE_LOWER:
             print("Checkmate!")
 
         # The black player moves from a rotated position, so we have to
@@ -1,4 +1,6 @@
+import argparse
 import itertools
+import multiprocessing
 import re
 import time
 import sys
@@ -34,14 +36,14 @@ def gen_legal_moves(pos):
     ''' pos.gen_moves(), but without those that leaves us in check.
         Also the position after moving is included. '''
     for move in pos.gen_moves():
-        pos1 = pos.move(move)
+        pos1 = pos.move(move)[0]
         if not can_kill_king(pos1):
             yield move, pos1
 
 def can_kill_king(pos):
     # If we just checked for opponent moves capturing the king, we would miss
     # captures in case of illegal castling.
-    return any(pos.value(m) >= sunfish.MATE_LOWER for m in pos.gen_moves())
+    return pos.can_capture_king()
 
 def mrender(pos, m):
     # Sunfish always assumes promotion to queen
@@ -61,12 +63,11 @@ def renderSAN(pos, move):
     if get_color(pos) == BLACK:
         csrc, cdst = sunfish.render(119-i), sunfish.render(119-j)
     # Check
-    pos1 = pos.move(move)
-    cankill = lambda p: any(p.board[b]=='k' for a,b in p.gen_moves())
+    pos1 = pos.move(move)[0]
     check = ''
-    if cankill(pos1.rotate()):
+    if pos1.in_check():
         check = '+'
-        if all(cankill(pos1.move(move1)) for move1 in pos1.gen_moves()):
+        if not any(gen_legal_moves(pos1)):
             check = '#'
     # Castling
     if pos.board[i] == 'K' and abs(i-j) == 2:
@@ -136,7 +137,7 @@ def readPGN(file):
                 print('PGN was:', ' '.join(lines))
                 raise
             yield pos, move
-            pos = pos.move(move)
+            pos = pos.move(move)[0]
 
     # TODO: Currently assumes all games start at the initial position.
     current_game = []
@@ -171,7 +172,7 @@ def parseFEN(fen):
     ep = sunfish.parse(enpas) if enpas != '-' else 0
     score = sum(sunfish.pst[p][i] for i,p in enumerate(board) if p.isupper())
     score -= sum(sunfish.pst[p.upper()][119-i] for i,p in enumerate(board) if p.islower())
-    pos = sunfish.Position(board, score, wc, bc, ep, 0)
+    pos = sunfish.Position(board, score, wc, bc, ep, 0, sunfish.zobrist(board))
     return pos if color == 'w' else pos.rotate()
 
 def renderFEN(pos, half_move_clock=0, full_move_clock=1):
@@ -206,6 +207,14 @@ def parseEPD(epd, opt_dict=False):
 # Pretty print
 ################################################################################
 
+def render_pv(pos, moves):
+    ''' The moves played one after the other from pos, such as Searcher.pv, in uci notation '''
+    res = []
+    for move in moves:
+        res.append(mrender(pos, move))
+        pos = pos.move(move)[0]
+    return ' '.join(res)
+
 def pv(searcher, pos, include_scores=True, include_loop=False):
     res = []
     seen_pos = set()
@@ -214,7 +223,7 @@ def pv(searcher, pos, include_scores=True, include_loop=False):
     if include_scores:
         res.append(str(pos.score))
     while True:
-        move = searcher.tp_move.get(pos)
+        move = searcher.tt.get_move(pos.key)
         # The tp may have illegal moves, given lower depths don't detect king killing
         if move is None or can_kill_king(pos.move(move)[0]):
             break
@@ -258,6 +267,50 @@ def flatten_tree(tree, depth):
         for pos in flatten_tree(subtree, depth-1):
             yield pos
 
+################################################################################
+# Perft
+################################################################################
+
+# Legal move sequences of depth 1, 2, ... from each position. Sunfish only
+# promotes to queens, so the counts are lower than the usual ones once
+# promotions come into play.
+PERFT_COUNTS = {
+    FEN_INITIAL: (20, 400, 8902, 197281),
+    # Kiwipete
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1': (48, 2039, 97862, 4074224),
+    '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1': (14, 191, 2812, 43238),
+    'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1': (6, 228, 8087, 320802),
+    'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8': (41, 1373, 54007, 1806790),
+    'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10': (46, 2079, 89890, 3894594),
+}
+
+def perft(pos, depth):
+    ''' Number of legal move sequences of length depth from pos '''
+    return sum(1 for _ in collect_tree_depth(expand_position(pos), depth))
+
+def divide(pos, depth, processes=1):
+    ''' Perft of the subtree of each legal move of pos, by move. With several
+        processes, the subtrees are counted by a pool of that size. '''
+    moves = list(gen_legal_moves(pos))
+    subtrees = [ (pos1, depth-1) for _, pos1 in moves ]
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            counts = pool.starmap(perft, subtrees)
+    else:
+        counts = list(itertools.starmap(perft, subtrees))
+    return { move: count for (move, _), count in zip(moves, counts) }
+
+def perft_suite(depth, processes=1, convert=None):
+    ''' Yields the fen, nodes, expected nodes and seconds of each position of
+        PERFT_COUNTS, with the positions converted by convert if given '''
+    for fen, counts in PERFT_COUNTS.items():
+        pos = parseFEN(fen)
+        if convert is not None:
+            pos = convert(pos)
+        start = time.time()
+        nodes = sum(divide(pos, depth, processes).values())
+        yield fen, nodes, counts[depth-1] if depth <= len(counts) else None, time.time() - start
+
 ################################################################################
 # Non chess related tools
 ################################################################################
@@ -274,3 +327,25 @@ class Unbuffered(object):
     def __getattr__(self, attr):
         return getattr(self.stream, attr)
 
+
+def main():
+    parser = argparse.ArgumentParser(description = 'perft node counts and speed of the move generator')
+    parser.add_argument('--depth', type = int, default = 3, help = 'optional; perft depth; default 3')
+    parser.add_argument('--processes', type = int, default = 1, help = 'optional; size of the pool the subtrees are split over; default 1')
+    parser.add_argument('--bitboards', action = 'store_true', help = 'optional; use the bitboard positions')
+    args = parser.parse_args()
+
+    convert = None
+    if args.bitboards:
+        import bitboard
+        convert = bitboard.from_position
+    ok, total_nodes, total_time = True, 0, 0.0
+    for fen, nodes, expected, elapsed in perft_suite(args.depth, args.processes, convert):
+        ok &= expected is None or nodes == expected
+        total_nodes, total_time = total_nodes + nodes, total_time + elapsed
+        print('{:>10} {:>10} {:>8.0f} nps {}'.format(nodes, '?' if expected is None else expected, nodes / elapsed, fen))
+    print('{} nodes in {:.2f}s, {:.0f} nps{}'.format(total_nodes, total_time, total_nodes / total_time, '' if ok else ', WRONG COUNTS'))
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
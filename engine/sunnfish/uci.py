@@ -4,17 +4,103 @@
 from __future__ import print_function
 from __future__ import division
 import importlib
+import json
 import re
 import sys
 import time
 import logging
 import argparse
+import threading
 
 import tools
 import sunfish
+import nnet
+import bitboard
+import smp
 
 from tools import WHITE, BLACK, Unbuffered
 
+# Positions searched by bench, the perft positions and a few quieter ones
+BENCH_POSITIONS = list(tools.PERFT_COUNTS) + [
+    'r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4',
+    'r2q1rk1/pp2bppp/2n1pn2/3p4/3P4/2NBPN2/PP3PPP/R2Q1RK1 w - - 0 10',
+    '2r3k1/5pp1/p3p2p/1p1rP3/3R4/1P3P2/P5PP/3R2K1 w - - 0 30',
+    '8/8/8/4k3/8/4K3/4P3/8 w - - 0 1',
+]
+BENCH_DEPTH = 5
+
+def render_score(score):
+    ''' The uci score, in moves to mate for mate scores '''
+    if abs(score) >= sunfish.MATE_LOWER:
+        return 'mate {}'.format(sunfish.mate_in(score))
+    return 'cp {}'.format(score)
+
+class TimeManager:
+    """ Soft and hard limits, in seconds, for the search of one move
+    The search is cut at the hard limit, and is not continued with another iteration
+    once past the soft limit. On a clock, the soft limit is halved while the best move
+    stays the same and doubled after the score drops, but never passes the hard limit.
+    While pondering there are no limits, the clock only starts at the ponderhit.
+    """
+
+    # Moves we expect to still play when the clock has no movestogo
+    MOVES_TO_GO = 30
+    # Seconds we keep on the clock for the time it takes to read and send moves
+    OVERHEAD = 0.05
+    # Largest parts of the time left the soft and the hard limit may take, so that even
+    # with one move to go a slow iteration does not lose on time
+    MAX_SOFT = 1/2
+    MAX_HARD = 3/4
+    # Iterations with the same best move before the soft limit is halved
+    STABLE = 2
+    # Centipawns the score has to drop between iterations for the soft limit to double
+    SCORE_DROP = 30
+
+    def __init__(self, time_left=None, inc=0, movestogo=None, movetime=None, ponder=False):
+        self.start = time.time()
+        self.pondering, self.timer = ponder, None
+        self.flexible = movetime is None and time_left is not None
+        if movetime is not None:
+            self.soft = self.hard = movetime / 1000
+        elif time_left is not None:
+            left = max(0, time_left / 1000 - TimeManager.OVERHEAD)
+            self.soft = min(left * TimeManager.MAX_SOFT, left / (movestogo or TimeManager.MOVES_TO_GO) + inc / 1000 * 3/4)
+            self.hard = min(left * TimeManager.MAX_HARD, 4 * self.soft)
+        else:
+            self.soft = self.hard = float('inf')
+        self.move, self.score, self.stable = None, None, 0
+
+    @property
+    def timelimit(self):
+        return float('inf') if self.pondering else self.start + self.hard
+
+    def ponderhit(self, stop):
+        ''' Starts the clock, stop is called if the search is still running at the hard limit '''
+        self.start, self.pondering = time.time(), False
+        if self.hard != float('inf'):
+            self.timer = threading.Timer(self.hard, stop)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def iteration(self, move, score):
+        ''' Records the result of an iteration, and tells if it is time to stop '''
+        self.stable = self.stable + 1 if move == self.move else 0
+        soft = self.soft
+        if self.flexible:
+            if self.stable >= TimeManager.STABLE:
+                soft /= 2
+            if self.score is not None and score < self.score - TimeManager.SCORE_DROP:
+                soft *= 2
+        self.move, self.score = move, score
+        return not self.pondering and self.elapsed() >= min(soft, self.hard)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('module', help='sunfish.py file (without .py)', type=str, default='sunfish', nargs='?')
@@ -28,14 +114,112 @@ def main():
 
     logging.basicConfig(filename='sunfish.log', level=logging.DEBUG)
     out = Unbuffered(sys.stdout)
+    # The search thread and the command loop both write
+    output_lock = threading.Lock()
     def output(line):
-        print(line, file=out)
-        logging.debug(line)
+        with output_lock:
+            print(line, file=out)
+            logging.debug(line)
     pos = tools.parseFEN(tools.FEN_INITIAL)
     searcher = sunfish.Searcher()
+    # The searcher, or the lazy smp search around it when there are several threads
+    engine = searcher
     color = WHITE
     our_time, opp_time = 1000000, 1000000 # time in centi-seconds
     show_thinking = True
+    bitboards = False
+    multipv = 1
+    # Search statistics, if any, are appended here as a line of JSON after each search
+    stats_file = ''
+    # The search runs on this thread, so commands are still read while it searches
+    thread, clock = None, None
+
+    def think(pos, depth, clock, infinite):
+        """ Searches pos on the search thread, until stopped or out of depth or time, and
+            outputs the best move. With go infinite the best move waits for stop, and while
+            pondering for stop or ponderhit. """
+        start = clock.start
+        sdepth, moves = None, ''
+        timelimit = clock.timelimit
+
+        def currmove(depth, move, number):
+            # Only once the search takes long enough for the user to wonder, the root is
+            # searched several times per iteration
+            if time.time() - start >= 3:
+                output('info depth {} currmove {} currmovenumber {}'.format(depth, tools.mrender(pos, move), number))
+        searcher.on_root_move = currmove
+
+        def info(sdepth, score, line, k=None):
+            usedtime = time.time() - start
+            output('info depth {} seldepth {}{} score {} time {} nodes {} nps {} hashfull {} pv {}'.format(
+                sdepth, max(sdepth, searcher.seldepth), '' if k is None else ' multipv {}'.format(k), render_score(score),
+                int(usedtime * 1000), engine.nodes, int(engine.nodes / max(usedtime, 0.001)), searcher.tt.hashfull(), line))
+
+        if multipv > 1:
+            # The lines are those of this process, the helpers of lazy smp only fill the table
+            searches = engine.search_lines(pos, timelimit = timelimit, startingdepth = 4, multipv = multipv)
+        else:
+            searches = ((sdepth, [ (move, score) ]) for sdepth, move, score in engine.search(pos, timelimit = timelimit, startingdepth = 4))
+        for sdepth, lines in searches:
+            if searcher.pv[:1] == [ lines[0][0] ]:
+                moves = tools.render_pv(pos, searcher.pv)
+            else:
+                # The iteration came from a helper process, its line is only in the shared table
+                moves = tools.pv(searcher, pos, include_scores=False)
+            if moves.strip() == "": break
+            if multipv > 1:
+                for k, (move, score) in enumerate(lines, 1):
+                    info(sdepth, score, tools.render_pv(pos, searcher.pvs[k-1]), k)
+            else:
+                entry = searcher.tt.get(pos.key, sdepth, True)
+                score = lines[0][1]
+                # Mate scores are exact, others the middle of the bounds of the table
+                if entry is not None and abs(score) < sunfish.MATE_LOWER:
+                    score = int(round((entry.lower + entry.upper)/2))
+                info(sdepth, score, moves)
+
+            if clock.iteration(*lines[0]):
+                break
+
+            if sdepth >= depth or searcher.stop.value:
+                break
+
+        # The best move of an infinite search is only wanted once it is stopped
+        while (infinite or clock.pondering) and not searcher.stop.value:
+            time.sleep(.01)
+        clock.cancel()
+
+        output('info string nncalls {} nnpositions {} cachehits {} cachemisses {} cachesize {}'.format(
+            searcher.nn_calls, searcher.nn_positions, searcher.nn_cache.hits, searcher.nn_cache.misses, len(searcher.nn_cache)))
+        output('info string cutoffs {} firstcutoffs {} firstcutoffrate {:.3f}'.format(
+            searcher.cutoffs, searcher.first_cutoffs, searcher.first_cutoffs / max(1, searcher.cutoffs)))
+        if searcher.stats is not None:
+            report = searcher.stats.report(searcher)
+            output('info string stats ' + ' '.join('{} {}'.format(name, value) for name, value in report.items()))
+            if stats_file:
+                with open(stats_file, 'a') as f:
+                    print(json.dumps(dict(fen=tools.renderFEN(pos), depth=sdepth, **report)), file=f)
+
+        # Stopped before the first iteration, we play the move with the best intrinsic value
+        if sdepth is None:
+            moves = tools.mrender(pos, max(pos.gen_moves(), key=pos.value))
+        entry = searcher.tt.get(pos.key, sdepth, True) if sdepth is not None else None
+        # We only resign once we are mated.. That's never?
+        if entry is not None and entry.lower <= -(sunfish.MATE_UPPER - 2):
+            output('resign')
+        else:
+            moves = moves.split(' ')
+            if len(moves) > 1:
+                output(f'bestmove {moves[0]} ponder {moves[1]}')
+            else:
+                output('bestmove ' + moves[0])
+
+
+    def stop_search():
+        ''' Stops the search, if any, once it has output its best move '''
+        if thread is not None and thread.is_alive():
+            searcher.stop.value = True
+            thread.join()
 
     stack = []
     while True:
@@ -47,23 +231,74 @@ def main():
         logging.debug(f'>>> {smove} ')
 
         if smove == 'quit':
+            stop_search()
+            if engine is not searcher:
+                engine.close()
             break
 
         elif smove == 'uci':
             output('id name Sunfish')
             output('id author Thomas Ahle & Contributors')
+            output('option name Hash type spin default {} min 1 max 65536'.format(sunfish.HASH_MB))
+            output('option name Threads type spin default 1 min 1 max 256')
+            output('option name MultiPV type spin default 1 min 1 max 256')
+            output('option name Ponder type check default false')
+            output('option name EvalCache type spin default {} min 0 max 65536'.format(sunfish.NN_CACHE_MB))
+            output('option name Bitboards type check default false')
+            output('option name Stats type check default false')
+            output('option name StatsFile type string default <empty>')
+            output('option name NNBackend type combo default {} {}'.format(sunfish.NN_BACKEND, ' '.join('var ' + b for b in nnet.BACKENDS)))
             output('uciok')
 
         elif smove == 'isready':
+            # GUIs wait for readyok before the first go, so the network loads here and
+            # not on the clock of the first search
+            sunfish.load_model()
             output('readyok')
 
+        elif smove.startswith('setoption'):
+            stop_search()
+            # setoption name <id> [value <x>]
+            match = re.match(r'setoption name (.+?)(?: value (.*))?$', smove)
+            if match is None:
+                continue
+            name, value = match.groups()
+            if name in ('Hash', 'Threads'):
+                threads = engine.threads if engine is not searcher else 1
+                if engine is not searcher:
+                    engine.close()
+                    engine = searcher
+                if name == 'Hash':
+                    searcher.tt.resize(int(value))
+                else:
+                    threads = int(value)
+                if threads > 1:
+                    engine = smp.LazySMP(searcher, threads)
+            elif name == 'MultiPV':
+                multipv = int(value)
+            elif name == 'EvalCache':
+                searcher.nn_cache.resize(int(value))
+            elif name == 'Bitboards':
+                bitboards = value == 'true'
+            elif name == 'Stats':
+                searcher.stats = sunfish.SearchStats() if value == 'true' else None
+            elif name == 'StatsFile':
+                stats_file = '' if value in (None, '<empty>') else value
+            elif name == 'NNBackend' and value != sunfish.NN_BACKEND:
+                sunfish.NN_BACKEND = value
+                if sunfish.NN_MODEL is not None:
+                    sunfish.load_model(reload=True)
+                    searcher.nn_cache.clear()
+
         elif smove == 'ucinewgame':
+            sunfish.load_model()
             stack.append('position fen ' + tools.FEN_INITIAL)
 
         # syntax specified in UCI
         # position [fen  | startpos ]  moves  ....
 
         elif smove.startswith('position'):
+            stop_search()
             params = smove.split(' ')
             idx = smove.find('moves')
 
@@ -87,65 +322,85 @@ def main():
                 pass
 
             pos = tools.parseFEN(fen)
+            if bitboards:
+                pos = bitboard.from_position(pos)
             color = WHITE if fen.split()[1] == 'w' else BLACK
 
             for move in moveslist:
                 pos = pos.move(tools.mparse(color, move))[0]
                 color = 1 - color
 
-        elif smove.startswith('go'):
-            #  default options
-            depth = 1
-            movetime = 600000
-
-            _, *params = smove.split(' ')
-            for param, val in zip(*2*(iter(params),)):
-                if param == 'depth':
-                    depth = int(val)
-                if param == 'movetime':
-                    movetime = int(val)
-                if param == 'wtime':
-                    our_time = int(val)
-                if param == 'btime':
-                    opp_time = int(val)
-
-            moves_remain = 1
-
+        elif smove.split()[:1] == [ 'bench' ]:
+            stop_search()
+            # Fixed depth searches of BENCH_POSITIONS by fresh searchers, so the nodes are a
+            # signature of the search, on the piece square tables and on the network if any
+            params = smove.split()[1:]
+            depth = int(params[0]) if params else BENCH_DEPTH
+            sunfish.load_model()
+            network = sunfish.model
+            modes = [ ('pst', None) ] + ([ ('nn', network) ] if network is not None else [])
+            try:
+                for mode, m in modes:
+                    sunfish.set_model(m)
+                    nodes, usedtime = 0, 0.0
+                    for k, fen in enumerate(BENCH_POSITIONS, 1):
+                        bench_pos = tools.parseFEN(fen)
+                        if bitboards:
+                            bench_pos = bitboard.from_position(bench_pos)
+                        bench_searcher = sunfish.Searcher()
+                        start = time.time()
+                        for sdepth, _move, _score in bench_searcher.search(bench_pos):
+                            if sdepth >= depth:
+                                break
+                        usedtime += time.time() - start
+                        nodes += bench_searcher.nodes
+                        output('info string bench mode {} position {} nodes {}'.format(mode, k, bench_searcher.nodes))
+                    output('bench mode {} depth {} positions {} nodes {} time {} nps {}'.format(
+                        mode, depth, len(BENCH_POSITIONS), nodes, int(usedtime * 1000), int(nodes / max(usedtime, 0.001))))
+            finally:
+                sunfish.set_model(network)
+
+        elif smove.startswith('go perft'):
+            stop_search()
+            # Counts the legal move sequences by first move, over a pool of Threads processes
             start = time.time()
-            ponder = None
-            timelimit = time.time() + movetime / 1000
-            for sdepth, _move, _score in searcher.search(pos, timelimit = timelimit, startingdepth = 4):
-                moves = tools.pv(searcher, pos, include_scores=False)
-                if moves.strip() == "": break
-                entry = searcher.tp_score.get((pos, sdepth, True))
-                score = int(round((entry.lower + entry.upper)/2))
-                usedtime = int((time.time() - start) * 1000)
-                moves_str = moves if len(moves) < 15 else ''
-                output('info depth {} score cp {} time {} nodes {} pv {}'.format(sdepth, score, usedtime, searcher.nodes, moves_str))
-
-                if len(moves) > 5:
-                    ponder = moves[1]
-
-                if movetime > 0 and (time.time() - start) * 1000 > movetime:
-                    break
-
-                if (time.time() - start) * 1000 > our_time/moves_remain:
-                    break
-
-                if sdepth >= depth:
-                    break
-
-            entry = searcher.tp_score.get((pos, sdepth, True))
-            m, s = searcher.tp_move.get(pos), entry.lower
-            # We only resign once we are mated.. That's never?
-            if s == -sunfish.MATE_UPPER:
-                output('resign')
+            counts = tools.divide(pos, int(smove.split()[2]), engine.threads if engine is not searcher else 1)
+            for move, count in counts.items():
+                output('{}: {}'.format(tools.mrender(pos, move), count))
+            nodes, usedtime = sum(counts.values()), time.time() - start
+            output('')
+            output('Nodes searched: {}'.format(nodes))
+            output('info string time {} nps {}'.format(int(usedtime * 1000), int(nodes / max(usedtime, 0.001))))
+
+        elif smove.startswith('go'):
+            stop_search()
+            params = smove.split()[1:]
+            infinite, ponder = 'infinite' in params, 'ponder' in params
+            go = { param: int(val) for param, val in zip(params, params[1:]) if val.isdigit() }
+            # Without a depth we search as deep as the time allows, without any limit just one iteration
+            clocked = any(k in go for k in ('wtime', 'btime', 'movetime'))
+            depth = go.get('depth', 1000 if clocked or infinite else 1)
+            # Without an isready before, the network is loaded before the clock starts
+            sunfish.load_model()
+            if infinite:
+                clock = TimeManager()
+            elif 'wtime' in go or 'btime' in go:
+                ours = 'w' if color == WHITE else 'b'
+                clock = TimeManager(go.get(ours + 'time'), go.get(ours + 'inc', 0), go.get('movestogo'), go.get('movetime'), ponder)
             else:
-                moves = moves.split(' ')
-                if len(moves) > 1:
-                    output(f'bestmove {moves[0]} ponder {moves[1]}')
-                else:
-                    output('bestmove ' + moves[0])
+                clock = TimeManager(movetime = go.get('movetime', 600000), ponder = ponder)
+
+            searcher.stop.value = False
+            thread = threading.Thread(target=think, args=(pos, depth, clock, infinite), daemon=True)
+            thread.start()
+
+        elif smove == 'stop':
+            stop_search()
+
+        elif smove == 'ponderhit':
+            # The opponent played the move we pondered on, the search goes on as a normal one
+            if thread is not None and thread.is_alive() and clock.pondering:
+                clock.ponderhit(lambda: setattr(searcher.stop, 'value', True))
 
         elif smove.startswith('time'):
             our_time = int(smove.split()[1])